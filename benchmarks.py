@@ -0,0 +1,750 @@
+"""
+Benchmarks for the goal tree and the production rule engine.
+
+Run all of them with `python benchmarks.py`, or only some of them by name:
+`python benchmarks.py forward_chain`.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import regex
+
+import node
+import production
+import utils
+from production import IF, AND, OR, THEN, DELETE
+from game import AkinatorServer
+from grammar import NoopCorrector
+from metrics import METRICS
+from node import GoalTree
+from questions import STRATEGIES, simulate
+from rete import ReteEngine, rete_forward_chain
+from rules_example_zookeeper import ZOOKEEPER_RULES
+from session import AkinatorSession
+from tracing import TRACER
+
+
+def best_of(function, repeat=5):
+    """Run `function` `repeat` times and return the fastest wall time in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, seconds, baseline=None):
+    line = f"  {name:<32} {seconds * 1000:10.2f} ms"
+    if baseline is not None:
+        line += f"   x{baseline / seconds:.1f}"
+    print(line)
+
+
+def layered_rules(layers=5, width=2500, and_size=3, or_size=2, seed=0):
+    """
+    Build a synthetic rule base shaped like a layered goal tree.
+    Layer 0 holds the leaf facts, every node of layer i + 1 gets `or_size` rules
+    whose antecedents are `and_size` random nodes of layer i.
+    """
+    rng = random.Random(seed)
+    rules = []
+    for layer in range(1, layers):
+        for i in range(width):
+            for _ in range(or_size):
+                antecedents = rng.sample(range(width), and_size)
+                rules.append(IF(AND(*[f"(?x) n{layer - 1}_{j}" for j in antecedents]),
+                                THEN(f"(?x) n{layer}_{i}")))
+    return rules
+
+
+def sweep_forward_chain(tree, data):
+    """The original fixpoint sweep over every node, kept as a baseline."""
+    known_facts = set(data)
+    inferred_facts = set()
+    while True:
+        applied_rule = False
+        for node in tree.nodes.values():
+            if node.value not in known_facts:
+                for and_set in node.or_set:
+                    if all(antecedent.value in known_facts for antecedent in and_set):
+                        known_facts.add(node.value)
+                        inferred_facts.add(node.value)
+                        applied_rule = True
+                        break
+        if not applied_rule:
+            break
+    return inferred_facts
+
+
+def diamond_rules(depth=7, width=6):
+    """
+    Build a rule base of stacked diamonds: every node of layer i + 1 depends on all the
+    nodes of layer i, so the number of paths from a top node to the leaves is width ** depth.
+    """
+    rules = []
+    for layer in range(1, depth + 1):
+        for i in range(width):
+            for j in range(0, width, 2):
+                rules.append(IF(AND(f"(?x) d{layer - 1}_{j}", f"(?x) d{layer - 1}_{j + 1}"),
+                                THEN(f"(?x) d{layer}_{i}")))
+    return rules
+
+
+def naive_leaf_closure(tree, hypothesis):
+    """The original path-by-path recursive_backward_chain, kept as a baseline."""
+    def recurse(node):
+        if not node.or_set:
+            return {node.value}
+        facts = set()
+        for and_set in node.or_set:
+            for child in and_set:
+                facts.update(recurse(child))
+        return facts
+    return recurse(tree.nodes[hypothesis])
+
+
+def zookeeper_data(individuals=200, seed=0):
+    """Random observations about many animals for the ZOOKEEPER_RULES."""
+    properties = ["has hair", "gives milk", "has feathers", "flies", "lays eggs", "eats meat",
+                  "has pointed teeth", "has claws", "has forward-pointing eyes", "has hoofs",
+                  "chews cud", "has tawny color", "has dark spots"]
+    rng = random.Random(seed)
+    return tuple(f"animal{i} {prop}" for i in range(individuals)
+                 for prop in rng.sample(properties, rng.randint(2, 7)))
+
+
+def uncompiled_match(template, AIStr):
+    """The original production.match, rewriting the template into a regex on every call."""
+    found = regex.match(utils.AIStringToRegex(template), AIStr)
+    return None if found is None else found.groupdict()
+
+
+def bench_forward_chain():
+    tree = GoalTree(layered_rules())
+    leaves = [value for value, node in tree.nodes.items() if not node.or_set]
+    data = random.Random(1).sample(leaves, len(leaves) * 3 // 4)
+    print(f"forward_chain: {len(tree.nodes)} nodes, {len(data)} known facts")
+    assert tree.forward_chain(data) == sweep_forward_chain(tree, data)
+    tree.forward_chain(data)  # build the chain index outside of the timing
+    baseline = best_of(lambda: sweep_forward_chain(tree, data), repeat=3)
+    report("sweep", baseline)
+    report("counters", best_of(lambda: tree.forward_chain(data)), baseline)
+
+
+def bench_backward_chain():
+    tree = GoalTree(diamond_rules())
+    hypotheses = [value for value, node in tree.nodes.items() if not node.parents]
+    print(f"recursive_backward_chain: {len(tree.nodes)} nodes, {len(hypotheses)} hypotheses")
+    assert all(tree.recursive_backward_chain(h) == naive_leaf_closure(tree, h) for h in hypotheses)
+
+    def build():
+        tree._invalidate_indexes()
+        tree.leaf_closures()
+
+    baseline = best_of(lambda: [naive_leaf_closure(tree, h) for h in hypotheses], repeat=1)
+    report("path by path", baseline)
+    report("index build", best_of(build), baseline)
+    report("index lookups", best_of(lambda: [tree.recursive_backward_chain(h) for h in hypotheses]),
+           baseline)
+
+
+def bench_questions():
+    tree = GoalTree(layered_rules(layers=3, width=60, and_size=2))
+    print(f"akinator questions: {len(tree.nodes)} nodes, "
+          f"{len(tree.hypothesis_index().hypotheses)} hypotheses")
+    for strategy in STRATEGIES:
+        start = time.perf_counter()
+        average, accuracy = simulate(tree, strategy, runs=2)
+        elapsed = time.perf_counter() - start
+        print(f"  {strategy:<18} {average:6.2f} questions per game, {accuracy:.0%} guessed right"
+              f" ({elapsed:.1f} s)")
+
+
+def bench_match():
+    data = zookeeper_data()
+    conditions = sorted({condition for rule in ZOOKEEPER_RULES
+                         for condition in rule.antecedent()})
+    print(f"production.match: {len(conditions)} conditions x {len(data)} facts")
+
+    def match_all(match):
+        return [match(condition, fact) for condition in conditions for fact in data]
+
+    assert match_all(uncompiled_match) == match_all(production.match)
+    baseline = best_of(lambda: match_all(uncompiled_match), repeat=3)
+    report("rewrite per call", baseline)
+    report("compiled templates", best_of(lambda: match_all(production.match), repeat=3), baseline)
+
+    data = zookeeper_data(individuals=40)
+    print(f"production.forward_chain: ZOOKEEPER_RULES over {len(data)} facts")
+    expected = production.forward_chain(ZOOKEEPER_RULES, data)
+    compiled_match = production.match
+    production.match = uncompiled_match
+    try:
+        assert production.forward_chain(ZOOKEEPER_RULES, data) == expected
+        baseline = best_of(lambda: production.forward_chain(ZOOKEEPER_RULES, data), repeat=1)
+    finally:
+        production.match = compiled_match
+    report("rewrite per call", baseline)
+    report("compiled templates",
+           best_of(lambda: production.forward_chain(ZOOKEEPER_RULES, data), repeat=1), baseline)
+
+
+def bench_fact_index():
+    data = zookeeper_data(individuals=100)
+    print(f"production.forward_chain: ZOOKEEPER_RULES over {len(data)} facts")
+    expected = production.forward_chain(ZOOKEEPER_RULES, data)
+    indexed = production.FactStore.candidates
+    production.FactStore.candidates = lambda store, pattern, bindings=None: store._facts
+    try:
+        assert production.forward_chain(ZOOKEEPER_RULES, data) == expected
+        baseline = best_of(lambda: production.forward_chain(ZOOKEEPER_RULES, data), repeat=1)
+    finally:
+        production.FactStore.candidates = indexed
+    report("linear scans", baseline)
+    report("token index",
+           best_of(lambda: production.forward_chain(ZOOKEEPER_RULES, data), repeat=1), baseline)
+
+
+MULTI_ACTION_RULES = ZOOKEEPER_RULES + (
+    IF(AND("(?x) is a mammal", "(?x) eats meat"), THEN("(?x) is a predator", "(?x) is fed")),
+    IF("(?x) is a bird", THEN("(?x) has wings", "(?x) is fed"), DELETE("(?x) flies")),
+    )
+
+
+def bench_rete():
+    # apply_only_one stops in the middle of a firing, its remaining actions come later
+    data = zookeeper_data(10)
+    for rules in (ZOOKEEPER_RULES, MULTI_ACTION_RULES):
+        for apply_only_one in (False, True):
+            assert (rete_forward_chain(rules, data, apply_only_one)
+                    == production.forward_chain(rules, data, apply_only_one))
+    assert rete_forward_chain([IF("(?x) p", THEN("(?x) q", "(?x) r"))], ("a p", "b p"), True) \
+        == ("a p", "a q", "a r", "b p", "b q", "b r")
+
+    print("rete_forward_chain: ZOOKEEPER_RULES, scaling the number of facts")
+    for individuals in (25, 50, 100, 200):
+        data = zookeeper_data(individuals)
+        assert rete_forward_chain(ZOOKEEPER_RULES, data) == production.forward_chain(ZOOKEEPER_RULES, data)
+        baseline = best_of(lambda: production.forward_chain(ZOOKEEPER_RULES, data), repeat=1)
+        report(f"forward_chain {len(data)} facts", baseline)
+        report(f"rete {len(data)} facts", best_of(lambda: rete_forward_chain(ZOOKEEPER_RULES, data), repeat=3),
+               baseline)
+
+    data = zookeeper_data(200)
+    engine = ReteEngine(ZOOKEEPER_RULES, data)
+    engine.run()
+    new_facts = [f"newcomer{i} has hair" for i in range(20)]
+
+    def add_and_run():
+        for fact in new_facts:
+            engine.add_fact(fact)
+            engine.run()
+
+    print(f"rete: adding {len(new_facts)} facts one at a time to {len(data)}")
+    report("delta propagation", best_of(add_and_run, repeat=1))
+
+
+ANCESTOR_RULES = (
+    IF(AND("(?x) parent (?y)"), THEN("(?x) ancestor (?y)")),
+    IF(AND("(?x) parent (?y)", "(?y) ancestor (?z)"), THEN("(?x) ancestor (?z)")),
+    )
+
+
+def bench_semi_naive():
+    for rules, data, name in ((ANCESTOR_RULES, tuple(f"p{i} parent p{i + 1}" for i in range(30)),
+                               "ancestor chain"),
+                              (ZOOKEEPER_RULES, zookeeper_data(100), "ZOOKEEPER_RULES")):
+        print(f"forward_chain semi_naive: {name}, {len(data)} facts")
+        assert (production.forward_chain(rules, data, semi_naive=True)
+                == production.forward_chain(rules, data))
+        baseline = best_of(lambda: production.forward_chain(rules, data), repeat=1)
+        report("naive", baseline)
+        report("semi-naive",
+               best_of(lambda: production.forward_chain(rules, data, semi_naive=True), repeat=1),
+               baseline)
+
+
+def copying_forward_chain(rules, data):
+    """The previous forward_chain loop, copying and sorting the data on every IF.apply."""
+    old_data = ()
+    while set(old_data) != set(data):
+        old_data = list(data)
+        for condition in rules:
+            data = condition.apply(data)
+            if set(data) != set(old_data):
+                break
+    return data
+
+
+def traced(function):
+    """Run `function` under tracemalloc, returning its peak traced memory in bytes."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_in_place():
+    data = zookeeper_data(200)
+    print(f"forward_chain in place: ZOOKEEPER_RULES over {len(data)} facts")
+    assert copying_forward_chain(ZOOKEEPER_RULES, data) == production.forward_chain(ZOOKEEPER_RULES, data)
+    for name, function in (("copy per apply", copying_forward_chain),
+                           ("in place", production.forward_chain)):
+        seconds = best_of(lambda: function(ZOOKEEPER_RULES, data), repeat=1)
+        peak = traced(lambda: function(ZOOKEEPER_RULES, data))
+        print(f"  {name:<32} {seconds * 1000:10.2f} ms {peak / 1024:10.1f} KiB peak")
+
+
+def clobber_join(pairs):
+    """Join binding sets the way the matcher did with NoClobberDict, failing by exception."""
+    joined = 0
+    for left, right in pairs:
+        bindings = utils.NoClobberDict(right)
+        try:
+            bindings.update(left)
+            joined += 1
+        except utils.ClobberedDictKey:
+            pass
+    return joined
+
+
+def bindings_join(pairs):
+    joined = 0
+    for left, right in pairs:
+        if left.extend(right) is not None:
+            joined += 1
+    return joined
+
+
+def bench_bindings():
+    rng = random.Random(0)
+    names = [f"animal{i}" for i in range(20)]
+    pairs = [({"x": rng.choice(names), "y": rng.choice(names)},
+              {"y": rng.choice(names), "z": rng.choice(names)}) for _ in range(20000)]
+    slotted = [(utils.Bindings(left), right) for left, right in pairs]
+    print(f"binding environments: {len(pairs)} joins")
+    assert clobber_join(pairs) == bindings_join(slotted)
+    baseline = best_of(lambda: clobber_join(pairs), repeat=3)
+    report("NoClobberDict", baseline)
+    report("Bindings.extend", best_of(lambda: bindings_join(slotted), repeat=3), baseline)
+
+
+def family_data(people=400, famous=5, seed=0):
+    """A random family tree where only a few people are famous."""
+    rng = random.Random(seed)
+    data = [f"p{i} parent p{rng.randrange(i + 1, people + 40)}" for i in range(people)]
+    data += [f"p{i} is famous" for i in rng.sample(range(people), famous)]
+    return tuple(data)
+
+
+FAMOUS_GRANDPARENT_RULES = (
+    IF(AND("(?x) parent (?y)", "(?y) parent (?z)", "(?z) is famous"),
+       THEN("(?x) has a famous grandchild")),
+    )
+
+
+def bench_join_order():
+    data = family_data()
+    rule = FAMOUS_GRANDPARENT_RULES[0]
+    print(f"AND join order: {rule.antecedent()} over {len(data)} facts")
+    print("  " + str(rule.antecedent().plan(data)).replace("\n", "\n  "))
+    expected = production.forward_chain(FAMOUS_GRANDPARENT_RULES, data)
+    planned = AND.plan
+    AND.plan = lambda self, rules, bound=(): production.JoinPlan((c, None) for c in self)
+    try:
+        assert production.forward_chain(FAMOUS_GRANDPARENT_RULES, data) == expected
+        baseline = best_of(lambda: production.forward_chain(FAMOUS_GRANDPARENT_RULES, data), repeat=3)
+    finally:
+        AND.plan = planned
+    report("written order", baseline)
+    report("planned order",
+           best_of(lambda: production.forward_chain(FAMOUS_GRANDPARENT_RULES, data), repeat=3), baseline)
+
+
+def ladder_rules(depth):
+    """
+    A chain of `depth` rungs where both goals of a rung need both goals of the rung
+    below, so expanding the top goal without sharing visits 2 ** depth sub-goals.
+    """
+    rules = []
+    for rung in range(1, depth + 1):
+        for goal in "ab":
+            rules.append(IF(AND(f"(?x) a{rung - 1}", f"(?x) b{rung - 1}"),
+                            THEN(f"(?x) {goal}{rung}")))
+    return rules
+
+
+def unshared_backward_chain(rules, hypothesis):
+    """The lab's backward chaining, scanning every rule and re-expanding every sub-goal."""
+    result = OR(hypothesis)
+    for rule in rules:
+        for consequent in rule.consequent():
+            bindings = production.match(consequent, hypothesis)
+            if bindings is not None:
+                result.append(AND(*[unshared_backward_chain(rules, production.populate(c, bindings))
+                                    for c in rule.antecedent()]))
+    return production.simplify(result)
+
+
+def bench_goal_tree():
+    for depth in (8, 10, 12):
+        rules = ladder_rules(depth)
+        hypothesis = f"x a{depth}"
+        print(f"production.backward_chain: {len(rules)} rules, ladder of depth {depth}")
+        assert production.backward_chain(rules, hypothesis) == unshared_backward_chain(rules, hypothesis)
+        baseline = best_of(lambda: unshared_backward_chain(rules, hypothesis), repeat=1)
+        report("unshared", baseline)
+        report("indexed and memoized", best_of(lambda: production.backward_chain(rules, hypothesis)),
+               baseline)
+
+
+def str_uniq_simplify(node):
+    """The previous production.simplify, deduplicating branches by their str()."""
+    if not isinstance(node, production.RuleExpression):
+        return node
+    branches = production.uniq([str_uniq_simplify(x) for x in node])
+    if isinstance(node, AND):
+        kind, absorbing = AND, production.FAIL
+    elif isinstance(node, OR):
+        kind, absorbing = OR, production.PASS
+    else:
+        return node
+    if any(branch == absorbing for branch in branches):
+        return absorbing
+    pieces = []
+    for branch in branches:
+        if isinstance(branch, kind):
+            pieces.extend(branch)
+        else:
+            pieces.append(branch)
+    return pieces[0] if len(pieces) == 1 else kind(*pieces)
+
+
+def raw_goal_tree(depth):
+    """The unsimplified goal tree of the top of a ladder (see ladder_rules), sharing subtrees."""
+    trees = {"a": "x a0", "b": "x b0"}
+    for rung in range(1, depth + 1):
+        below = AND(trees["a"], trees["b"])
+        trees = {goal: OR(f"x {goal}{rung}", below) for goal in "ab"}
+    return trees["a"]
+
+
+def bench_simplify():
+    for depth in (8, 10, 12):
+        tree = raw_goal_tree(depth)
+        print(f"production.simplify: goal tree of a ladder of depth {depth}")
+        assert str(production.simplify(tree)) == str(str_uniq_simplify(tree))
+        baseline = best_of(lambda: str_uniq_simplify(tree), repeat=1)
+        report("str() uniq", baseline)
+        report("hash-consed", best_of(lambda: production.simplify(tree)), baseline)
+
+
+def bench_compiled():
+    tree = GoalTree(layered_rules())
+    leaves = [value for value, node in tree.nodes.items() if not node.or_set]
+    rng = random.Random(1)
+    datas = [rng.sample(leaves, len(leaves) * 3 // 4) for _ in range(500)]
+    compiled = tree.compiled()
+    print(f"compiled goal tree: {len(tree.nodes)} nodes, {len(datas)} fact sets")
+    expected = [tree.forward_chain(data) for data in datas]
+    assert [compiled.forward_chain(data) for data in datas] == expected
+    assert tree.forward_chain_batch(datas) == expected
+    baseline = best_of(lambda: [tree.forward_chain(data) for data in datas], repeat=1)
+    report("strings, one at a time", baseline)
+    report("bit arrays, one at a time",
+           best_of(lambda: [compiled.forward_chain(data) for data in datas], repeat=1), baseline)
+    report("packed batch", best_of(lambda: tree.forward_chain_batch(datas), repeat=3), baseline)
+
+
+def bench_forward_chain_many():
+    tree = GoalTree(layered_rules(width=500))
+    leaves = [value for value, node in tree.nodes.items() if not node.or_set]
+    rng = random.Random(1)
+    visitors = [rng.sample(leaves, len(leaves) * 3 // 5) for _ in range(5000)]
+    processes = max(2, os.cpu_count() or 1)
+    print(f"forward_chain_many: {len(tree.nodes)} nodes, {len(visitors)} observation sets")
+    expected = [tree.forward_chain(data) for data in visitors]
+    tree.compiled()  # build the compiled tree outside of the timing
+    for name, run in (("forward_chain loop", lambda: [tree.forward_chain(data) for data in visitors]),
+                      ("forward_chain_many", lambda: list(tree.forward_chain_many(iter(visitors)))),
+                      (f"forward_chain_many, {processes} processes",
+                       lambda: list(tree.forward_chain_many(iter(visitors), processes=processes)))):
+        assert run() == expected
+        seconds = best_of(run, repeat=1)
+        print(f"  {name:<32} {len(visitors) / seconds:10.0f} fact sets/s")
+
+
+class DictNode:
+    """The previous node.Node layout: a per-instance __dict__, sets, and no interning."""
+    def __init__(self, value, parents=None, or_set=None) -> None:
+        self.value = value
+        self.parents = parents if parents is not None else set()
+        self.or_set = or_set if or_set is not None else set()
+
+    def add_and_set(self, and_set):
+        self.or_set.add(frozenset(and_set))
+
+    def add_parent(self, parent):
+        self.parents.add(parent)
+
+    def children(self):
+        return {child for and_set in self.or_set for child in and_set}
+
+
+def bench_node_memory():
+    rules = layered_rules()
+    print(f"GoalTree memory: {len(rules)} rules")
+    slotted = node.Node
+    for name, node_class, compact in (("dict nodes", DictNode, False),
+                                      ("slotted, interned", slotted, False),
+                                      ("slotted, interned, compact", slotted, True)):
+        node.Node = node_class
+        try:
+            tracemalloc.start()
+            tree = GoalTree(rules, compact_nodes=compact)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        finally:
+            node.Node = slotted
+        print(f"  {name:<32} {size / len(tree.nodes):10.0f} bytes per node")
+
+
+def split_construct(rules):
+    """The previous GoalTree.construct, splitting every pattern of single-level AND rules."""
+    nodes = {}
+    for rule in rules:
+        consequent = " ".join(rule.consequent()[0].split()[1:])
+        antecedents = [" ".join(antecedent.split()[1:]) for antecedent in rule.antecedent()]
+        if consequent not in nodes:
+            nodes[consequent] = DictNode(consequent)
+        consequent_node = nodes[consequent]
+        and_set = set()
+        for antecedent in antecedents:
+            if antecedent not in nodes:
+                nodes[antecedent] = DictNode(antecedent)
+            and_set.add(nodes[antecedent])
+        consequent_node.or_set.add(frozenset(and_set))
+        for antecedent_node in and_set:
+            antecedent_node.parents.add(consequent_node)
+    return nodes
+
+
+def bench_construct():
+    rules = layered_rules(width=12500)
+    print(f"GoalTree construction: {len(rules)} rules")
+    assert set(split_construct(rules)) == set(GoalTree(rules).nodes)
+
+    def construct():
+        # IF compiles its patterns, but the facts of the patterns are parsed from scratch
+        node.pattern_parts.cache_clear()
+        GoalTree(rules)
+
+    baseline = best_of(lambda: split_construct(rules), repeat=3)
+    report("split per pattern", baseline)
+    report("parsed patterns", best_of(construct, repeat=3), baseline)
+
+
+def bench_snapshot():
+    rules = layered_rules()
+    path = os.path.join(tempfile.mkdtemp(), "layered.goaltree")
+    GoalTree(rules).save_compiled(path)
+    print(f"GoalTree snapshot: {len(rules)} rules, {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+
+    def build():
+        node.pattern_parts.cache_clear()
+        GoalTree(rules).leaf_closures()
+
+    baseline = best_of(build, repeat=3)
+    report("construct and close", baseline)
+    report("load_compiled", best_of(lambda: GoalTree.load_compiled(path, rules), repeat=3), baseline)
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def bench_concurrent_games(clients=1000):
+    tree = GoalTree(layered_rules(layers=3, width=60, and_size=2), corrector=NoopCorrector())
+    tree.precompute_questions()
+    hypotheses = tree.hypothesis_index().hypotheses
+    server = AkinatorServer(tree)
+    print(f"akinator server: {clients} concurrent games, {len(tree.nodes)} nodes")
+
+    async def client(port, world):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        reply = {"question": None}
+        message = {"start": True}
+        while message is not None:
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            question = reply["question"]
+            # NoopCorrector leaves the questions as "Does it <fact>?"
+            message = None if question is None else {"answer": question["text"][8:-1] in world}
+        writer.close()
+        await writer.wait_closed()
+        return reply["guesses"]
+
+    async def play():
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        rng = random.Random(0)
+        worlds = [tree.recursive_backward_chain(rng.choice(hypotheses)) for _ in range(clients)]
+        start = time.perf_counter()
+        results = await asyncio.gather(*(client(port, world) for world in worlds))
+        elapsed = time.perf_counter() - start
+        listener.close()
+        await listener.wait_closed()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(play())
+    assert all(results)
+    print(f"  {'one process, asyncio':<32} {clients / elapsed:10.0f} games/s")
+
+
+class CopyingSession(AkinatorSession):
+    """The previous AkinatorSession layout: full copies of the starting state of the tree."""
+    def __init__(self, tree) -> None:
+        super().__init__(tree)
+        core = tree.session_core()
+        self.possible_hypotheses = set(core.hypotheses)
+        self.possible_facts = set(core.facts)
+        self.possible_rules = set(core.rules)
+        self.deduced = set(core.deduced)
+        self._unmet = list(core.unmet)
+        self._open = dict(core.open)
+        self._support = dict(core.support)
+
+
+def bench_session_memory(sessions=10000, answers=5):
+    tree = GoalTree(layered_rules(width=10000)).freeze()
+    leaves = sorted(value for value, node in tree.nodes.items() if not node.or_set)
+    print(f"akinator session memory: {len(tree.nodes)} nodes, {answers} answers per session")
+
+    def measure(session_class, count):
+        rng = random.Random(0)
+        tracemalloc.start()
+        live = []
+        for _ in range(count):
+            session = session_class(tree)
+            for _ in range(answers):
+                session.record(rng.choice(leaves), rng.random() < 0.5)
+            live.append(session)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / count
+
+    copying = measure(CopyingSession, 20)
+    overlay = measure(AkinatorSession, sessions)
+    for name, size in (("full copies", copying), ("copy-on-write overlays", overlay)):
+        print(f"  {name:<32} {size / 1024:10.1f} KiB per session,"
+              f" {size * sessions / 2 ** 20:8.1f} MiB for {sessions} sessions")
+
+
+def scanned_exclusive_group(fact, mutually_exclusive, possible_facts):
+    """The previous lookup: scan the mutually exclusive sets, then check every member."""
+    for mutually_exclusive_set in mutually_exclusive:
+        if fact in mutually_exclusive_set:
+            if all(item in possible_facts for item in mutually_exclusive_set):
+                return mutually_exclusive_set
+            return None
+    return None
+
+
+def bench_exclusive(groups=2000):
+    tree = GoalTree(layered_rules(layers=3, width=4000, and_size=2))
+    leaves = sorted(value for value, node in tree.nodes.items() if not node.or_set)
+    rng = random.Random(0)
+    rng.shuffle(leaves)
+    mutually_exclusive = [set(leaves[i:i + 3]) for i in range(0, 3 * groups, 3)]
+    session = AkinatorSession(tree, mutually_exclusive)
+    for fact in leaves[:50]:
+        session.record(fact, rng.random() < 0.5)
+    facts = sorted(session.possible_facts)
+    print(f"mutually exclusive sets: {len(mutually_exclusive)} sets, "
+          f"{len(facts)} candidate facts per question")
+
+    def scanned():
+        return [scanned_exclusive_group(fact, mutually_exclusive, session.possible_facts)
+                for fact in facts]
+
+    assert scanned() == [session.exclusive_group(fact) for fact in facts]
+    baseline = best_of(scanned, repeat=1)
+    report("scan per fact", baseline)
+    report("exclusion index",
+           best_of(lambda: [session.exclusive_group(fact) for fact in facts]), baseline)
+
+
+def bench_tracing():
+    tree = GoalTree(layered_rules(layers=3, width=60, and_size=2))
+    print(f"session tracing: simulate over {len(tree.nodes)} nodes")
+    baseline = best_of(lambda: simulate(tree, "information_gain", runs=2), repeat=3)
+    report("tracing off", baseline)
+    with open(os.devnull, "w") as devnull:
+        TRACER.enable(devnull)
+        try:
+            report("JSON lines to /dev/null",
+                   best_of(lambda: simulate(tree, "information_gain", runs=2), repeat=3), baseline)
+        finally:
+            TRACER.disable()
+
+
+def bench_metrics():
+    tree = GoalTree(layered_rules())
+    leaves = [value for value, node in tree.nodes.items() if not node.or_set]
+    data = random.Random(1).sample(leaves, len(leaves) * 3 // 4)
+    facts = zookeeper_data(individuals=10)
+    tree.forward_chain(data)
+    print(f"metrics overhead: GoalTree.forward_chain over {len(tree.nodes)} nodes, "
+          f"production.forward_chain over {len(facts)} facts")
+
+    def run():
+        tree.forward_chain(data)
+        production.forward_chain(ZOOKEEPER_RULES, facts, semi_naive=True)
+
+    baseline = best_of(run, repeat=3)
+    report("metrics off", baseline)
+    METRICS.enable()
+    try:
+        report("metrics on", best_of(run, repeat=3), baseline)
+    finally:
+        METRICS.disable()
+        METRICS.reset()
+
+
+BENCHMARKS = {
+    "forward_chain": bench_forward_chain,
+    "backward_chain": bench_backward_chain,
+    "questions": bench_questions,
+    "match": bench_match,
+    "fact_index": bench_fact_index,
+    "rete": bench_rete,
+    "semi_naive": bench_semi_naive,
+    "in_place": bench_in_place,
+    "bindings": bench_bindings,
+    "join_order": bench_join_order,
+    "goal_tree": bench_goal_tree,
+    "simplify": bench_simplify,
+    "compiled": bench_compiled,
+    "forward_chain_many": bench_forward_chain_many,
+    "node_memory": bench_node_memory,
+    "construct": bench_construct,
+    "snapshot": bench_snapshot,
+    "concurrent_games": bench_concurrent_games,
+    "session_memory": bench_session_memory,
+    "exclusive": bench_exclusive,
+    "tracing": bench_tracing,
+    "metrics": bench_metrics,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,230 @@
+"""
+Compiled, integer-based representation of a GoalTree.
+
+Every node gets a dense integer id and every AND-set is stored as a row of a CSR incidence
+matrix (AND-set -> antecedent ids). Forward chaining then works on bit arrays indexed by
+node id instead of hashing strings: a single set of facts is a bytearray with one flag per
+node, and many sets of facts at once are the rows of a NumPy boolean matrix, all chained
+together with a few array operations per inference step.
+
+The string-based API (sets of facts in, set of inferred facts out) is a translation layer
+on top, see GoalTree.compiled().
+
+NumPy is optional; without it batches are chained one fact set at a time.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CompiledGoalTree:
+    """
+    Dense view of the nodes and AND-sets of a GoalTree.
+
+    Node ids follow the order of `tree.nodes`; `values[i]` is the value of node i and
+    `ids` maps a value back to its id. AND-set k proves node `consequents[k]` and needs the
+    `sizes[k]` nodes `indices[indptr[k]:indptr[k + 1]]`.
+    """
+    def __init__(self, tree) -> None:
+        values = list(tree.nodes)
+        ids = {value: i for i, value in enumerate(values)}
+        consequents = []
+        indptr = [0]
+        indices = []
+        for value, node in tree.nodes.items():
+            for and_set in node.or_set:
+                consequents.append(ids[value])
+                indices.extend(sorted(ids[child.value] for child in and_set))
+                indptr.append(len(indices))
+        self._setup(values, consequents, indptr, indices)
+
+    @classmethod
+    def from_csr(cls, values, consequents, indptr, indices):
+        """Build the compiled tree straight from its node values and AND-set arrays."""
+        compiled = cls.__new__(cls)
+        compiled._setup(list(values), list(consequents), list(indptr), list(indices))
+        return compiled
+
+    def _setup(self, values, consequents, indptr, indices):
+        self.values = values
+        self.ids = {value: i for i, value in enumerate(values)}
+        self.consequents = consequents
+        self.indptr = indptr
+        self.indices = indices
+        self.sizes = [indptr[idx + 1] - indptr[idx] for idx in range(len(consequents))]
+        self.watchers = [[] for _ in values]  # node id -> AND-sets it is an antecedent of
+        for idx in range(len(consequents)):
+            for child in indices[indptr[idx]:indptr[idx + 1]]:
+                self.watchers[child].append(idx)
+        self.unconditional = [idx for idx, size in enumerate(self.sizes) if size == 0]
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, facts):
+        """Return the bit array (one byte per node) flagging the facts that are nodes of the tree."""
+        known = bytearray(len(self.values))
+        for fact in facts:
+            i = self.ids.get(fact)
+            if i is not None:
+                known[i] = 1
+        return known
+
+    def decode(self, known):
+        """Return the set of node values flagged in the bit array `known`."""
+        values = self.values
+        return {values[i] for i, flag in enumerate(known) if flag}
+
+    def forward_chain_array(self, known):
+        """
+        Forward chain from the bit array `known`, setting the flag of every inferred node in
+        place and returning the ids of the inferred nodes. Works like GoalTree.forward_chain
+        on integer ids: each AND-set counts its antecedents that are not known yet and fires
+        when none are left.
+        """
+        unmet = list(self.sizes)
+        consequents = self.consequents
+        watchers = self.watchers
+        agenda = [i for i, flag in enumerate(known) if flag]
+        inferred = []
+        for idx in self.unconditional:
+            consequent = consequents[idx]
+            if not known[consequent]:
+                known[consequent] = 1
+                agenda.append(consequent)
+                inferred.append(consequent)
+        while agenda:
+            for idx in watchers[agenda.pop()]:
+                unmet[idx] -= 1
+                if unmet[idx] == 0:
+                    consequent = consequents[idx]
+                    if not known[consequent]:
+                        known[consequent] = 1
+                        agenda.append(consequent)
+                        inferred.append(consequent)
+        return inferred
+
+    def forward_chain(self, data):
+        """Same as GoalTree.forward_chain: return the set of facts inferred from `data`."""
+        values = self.values
+        return {values[i] for i in self.forward_chain_array(self.encode(data))}
+
+    def forward_chain_batch(self, datas, chunk_size=4096):
+        """
+        Forward chain many sets of facts at once, returning the list of inferred fact sets
+        in the same order. With NumPy the fact sets are chained `chunk_size` at a time as
+        the rows of a boolean matrix.
+        """
+        datas = list(datas)
+        if numpy is None:
+            return [self.forward_chain(data) for data in datas]
+        values = self.values
+        inferred = []
+        for start in range(0, len(datas), chunk_size):
+            known = self.encode_matrix(datas[start:start + chunk_size])
+            rows, columns = numpy.nonzero(self.forward_chain_matrix(known) & ~known)
+            bounds = numpy.searchsorted(rows, numpy.arange(len(known) + 1))
+            columns = columns.tolist()
+            for row in range(len(known)):
+                inferred.append({values[i] for i in columns[bounds[row]:bounds[row + 1]]})
+        return inferred
+
+    def forward_chain_many(self, fact_sets, chunk_size=1024, processes=None):
+        """
+        Yield the set of facts inferred from every fact set of the iterable `fact_sets`,
+        in order. The input is consumed `chunk_size` fact sets at a time, so it can be a
+        generator over a log too large to hold in memory. With `processes`, the chunks are
+        chained by that many worker processes, each receiving the compiled tree once.
+        """
+        fact_sets = iter(fact_sets)
+        chunks = iter(lambda: list(islice(fact_sets, chunk_size)), [])
+        if not processes:
+            for chunk in chunks:
+                yield from self.forward_chain_batch(chunk, chunk_size)
+            return
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(self,)) as pool:
+            # Keep a few chunks per worker in flight, without reading ahead any further
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_chain_chunk, chunk))
+                if len(pending) >= 2 * processes:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def __getstate__(self):
+        # The NumPy arrays are rebuilt where they are needed
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def encode_matrix(self, datas):
+        """Return the boolean matrix whose row i flags the nodes in datas[i]."""
+        known = numpy.zeros((len(datas), len(self.values)), dtype=bool)
+        ids = self.ids
+        for row, data in enumerate(datas):
+            known[row, [ids[fact] for fact in data if fact in ids]] = True
+        return known
+
+    def forward_chain_matrix(self, known):
+        """
+        Forward chain every row of the boolean matrix `known` (fact sets x nodes) and
+        return the matrix of known or inferred nodes.
+
+        The fact sets are packed eight to a byte, one row of bits per node, so each
+        inference step is two reductions over bit arrays: a bitwise and of the antecedent
+        rows of every AND-set, then a bitwise or of the AND-sets of every consequent.
+        """
+        indices, starts, groups, consequents, unconditional = self._matrix_arrays()
+        count = len(known)
+        bits = numpy.packbits(known.T, axis=1)
+        bits[unconditional] = numpy.packbits(numpy.ones(count, dtype=bool))
+        while len(starts):
+            satisfied = numpy.bitwise_and.reduceat(bits[indices], starts, axis=0)
+            proved = numpy.bitwise_or.reduceat(satisfied, groups, axis=0)
+            if not (proved & ~bits[consequents]).any():
+                break
+            bits[consequents] |= proved
+        return numpy.unpackbits(bits, axis=1, count=count).T.astype(bool)
+
+    def _matrix_arrays(self):
+        """
+        The CSR arrays of the AND-sets with antecedents, ordered by consequent, and the
+        start of the AND-sets of each consequent in that order. Built on first use.
+        """
+        if self._arrays is None:
+            conditional = sorted((idx for idx, size in enumerate(self.sizes) if size),
+                                 key=lambda idx: self.consequents[idx])
+            indices = []
+            starts = []
+            groups = []
+            consequents = []
+            for position, idx in enumerate(conditional):
+                starts.append(len(indices))
+                indices.extend(self.indices[self.indptr[idx]:self.indptr[idx + 1]])
+                if not consequents or consequents[-1] != self.consequents[idx]:
+                    groups.append(position)
+                    consequents.append(self.consequents[idx])
+            unconditional = [self.consequents[idx] for idx in self.unconditional]
+            self._arrays = tuple(numpy.asarray(array, dtype=numpy.intp) for array in
+                                 (indices, starts, groups, consequents, unconditional))
+        return self._arrays
+
+
+# The CompiledGoalTree of a worker process of forward_chain_many
+_worker_tree = None
+
+
+def _init_worker(compiled):
+    global _worker_tree
+    _worker_tree = compiled
+
+
+def _chain_chunk(chunk):
+    return _worker_tree.forward_chain_batch(chunk, len(chunk))
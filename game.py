@@ -0,0 +1,315 @@
+"""
+Akinator games without blocking I/O, and an asyncio server playing many of them at once.
+
+AkinatorGame drives one game over a GoalTree and never reads or prints anything:
+start() returns the first question, answer() records the answer to the pending question
+and returns the next one, and the game is over when it returns None. Questions are plain
+dicts ready to be sent as JSON:
+    {"kind": "fact", "text": "Does it ...?", "options": ["yes", "no"]}
+    {"kind": "exclusive", "text": "Please choose ...", "options": [fact, ...]}
+    {"kind": "rating", "text": "How familiar ...?", "options": ["1", ..., "5"]}
+
+Games only read the tree, so any number of them can share one GoalTree. The state of a
+game is the list of its answers (see AkinatorGame.state), small enough to keep in a
+cookie or a database row and resume later, possibly in another process.
+
+AkinatorServer plays one game per connection over newline-delimited JSON, see
+AkinatorServer.handle for the protocol.
+"""
+import asyncio
+import json
+import time
+
+from questions import STRATEGIES, apply_answer
+from session import AkinatorSession, ExclusionIndex
+from metrics import METRICS
+from tracing import TRACER
+
+EXCLUSIVE_QUESTION = "Please choose the correct fact from the following options:"
+
+
+class AkinatorGame:
+    """
+    One game over `tree`. `mutually_exclusive` and `questions` are the mutually exclusive
+    sets and rating questions of the rules, and `strategy` names the question selection
+    strategy from questions.STRATEGIES. Games can share the ExclusionIndex of the mutually
+    exclusive sets by passing it instead of the sets.
+    """
+    def __init__(self, tree, mutually_exclusive=(), questions=(),
+                 strategy="information_gain") -> None:
+        self.tree = tree
+        self.exclusion = ExclusionIndex.of(tree, mutually_exclusive)
+        self.questions = tuple(questions)
+        self.strategy = strategy
+        self._select = STRATEGIES[strategy]
+        self.session = None
+        self.answers = []     # (kind, key, answer) of every answered question
+        self._pending = None  # (kind, question) waiting for an answer
+        self._remaining = None
+
+    def start(self):
+        """Start a new game and return its first question, or None if there is nothing to ask."""
+        self.session = AkinatorSession(self.tree, self.exclusion)
+        self.answers = []
+        self._remaining = list(self.questions)
+        self._pending = None
+        self._advance()
+        return self.next_question()
+
+    def next_question(self):
+        """Return the question waiting for an answer, or None once the game is over."""
+        if self._pending is None:
+            return None
+        kind, question = self._pending
+        if kind == "fact":
+            return {"kind": kind, "text": self.tree.fact_question(question),
+                    "options": ["yes", "no"]}
+        if kind == "exclusive":
+            return {"kind": kind, "text": EXCLUSIVE_QUESTION, "options": sorted(question)}
+        return {"kind": kind, "text": next(iter(question)), "options": _options(kind, question)}
+
+    def answer(self, answer):
+        """
+        Answer the pending question and return the next one, or None once the game is over.
+        A fact question takes a bool or "yes"/"no", the others one of the options of the
+        question or its 1-based number. Raises ValueError for anything else.
+        """
+        if self._pending is None:
+            raise ValueError("No question is waiting for an answer")
+        kind, question = self._pending
+        answer = self._parse_answer(kind, question, answer)
+        apply_answer(self.session, kind, question, answer, self._remaining)
+        self.answers.append((kind, _question_key(kind, question), answer))
+        self._advance()
+        return self.next_question()
+
+    def finished(self):
+        return self.session is not None and self._pending is None
+
+    def guesses(self):
+        """Return the sorted hypotheses that follow from the answers so far."""
+        return sorted(self.session.guesses()) if self.session is not None else []
+
+    def state(self):
+        """
+        Return the state of the game as a JSON-serializable dict: the answers given so far
+        and the pending question. Restore it with from_state.
+        """
+        pending = None
+        if self._pending is not None:
+            pending = _question_key(*self._pending)
+        return {"strategy": self.strategy, "answers": [list(answer) for answer in self.answers],
+                "pending": [self._pending[0], pending] if pending is not None else None}
+
+    @classmethod
+    def from_state(cls, tree, state, mutually_exclusive=(), questions=()):
+        """
+        Resume the game of `state` (see state) over `tree`, which must be built from the
+        same rules. The answers are replayed on a new session without asking the strategy
+        again, so the game continues with the same pending question.
+
+        The state may come from a client, so every question and answer in it is checked
+        the way answer() checks a live answer. Raises ValueError if any of them is invalid.
+        """
+        try:
+            strategy = state["strategy"]
+            answers = [(kind, key, answer) for kind, key, answer in state["answers"]]
+            pending = state["pending"]
+            if pending is not None:
+                kind, key = pending
+                pending = (kind, key)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"Invalid game state: {error}") from None
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy!r}")
+
+        game = cls(tree, mutually_exclusive, questions, strategy)
+        game.session = AkinatorSession(tree, game.exclusion)
+        game._remaining = list(game.questions)
+        for kind, key, answer in answers:
+            question = game._find_askable(kind, key)
+            answer = game._parse_answer(kind, question, answer)
+            apply_answer(game.session, kind, question, answer, game._remaining)
+            game.answers.append((kind, key, answer))
+        if pending is not None:
+            game._pending = (pending[0], game._find_askable(*pending))
+        return game
+
+    def _advance(self):
+        session = self.session
+        started = time.perf_counter() if TRACER.enabled or METRICS.enabled else None
+        if session.possible_facts and not session.guesses():
+            self._pending = self._select(session, self._remaining)
+        else:
+            self._pending = None
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        if METRICS.enabled:
+            METRICS.observe("question_selection", seconds)
+        if TRACER.enabled:
+            kind, question = None, None
+            if self._pending is not None:
+                kind, question = self._pending[0], _question_key(*self._pending)
+            TRACER.event("question", session=id(session), strategy=self.strategy, kind=kind,
+                         question=question, seconds=seconds)
+
+    def _parse_answer(self, kind, question, answer):
+        if kind == "fact":
+            if isinstance(answer, bool):
+                return answer
+            if isinstance(answer, str) and answer.strip().lower() in ("yes", "no"):
+                return answer.strip().lower() == "yes"
+            raise ValueError(f"Expected yes or no, got {answer!r}")
+        options = _options(kind, question)
+        if isinstance(answer, int) and not isinstance(answer, bool) and 1 <= answer <= len(options):
+            return options[answer - 1]
+        if isinstance(answer, str):
+            if answer in options:
+                return answer
+            if answer.strip().isdigit() and 1 <= int(answer) <= len(options):
+                return options[int(answer) - 1]
+        raise ValueError(f"Expected one of {options} or its number, got {answer!r}")
+
+    def _find_question(self, kind, key):
+        """
+        Return the question of `kind` identified by `key`, see _question_key. Raises
+        ValueError unless it is a question the game can ask: a leaf fact of the tree, one of
+        the mutually exclusive sets or one of the rating questions.
+        """
+        if kind == "fact":
+            if isinstance(key, str) and key in self.tree.session_core().facts:
+                return key
+        elif kind == "exclusive":
+            if isinstance(key, list) and key and isinstance(key[0], str):
+                for g in self.exclusion.groups_of.get(key[0], ()):
+                    if list(self.exclusion.members[g]) == key:
+                        return self.exclusion.groups[g]
+        elif kind == "rating":
+            for question in self.questions:
+                if next(iter(question)) == key:
+                    return question
+        else:
+            raise ValueError(f"Unknown kind of question {kind!r}")
+        raise ValueError(f"Unknown {kind} question {key!r}")
+
+    def _find_askable(self, kind, key):
+        """
+        Return the question like _find_question, raising ValueError unless the session could
+        still ask it: its facts are possible and not asked yet, or the rating question was not
+        answered yet.
+        """
+        question = self._find_question(kind, key)
+        if kind == "rating":
+            askable = question in self._remaining
+        else:
+            facts = (question,) if kind == "fact" else question
+            session = self.session
+            askable = all(fact in session.possible_facts and fact not in session.asked_facts
+                          for fact in facts)
+        if not askable:
+            raise ValueError(f"The {kind} question {key!r} can't be asked anymore")
+        return question
+
+
+def _options(kind, question):
+    """
+    The options of an exclusive or rating question: the sorted facts, or the ratings in
+    the order the question lists them, so that "10" comes after "9".
+    """
+    if kind == "exclusive":
+        return sorted(question)
+    return list(question[next(iter(question))])
+
+
+def _question_key(kind, question):
+    """A JSON-serializable key of a question: the fact, the sorted set or the rating title."""
+    if kind == "fact":
+        return question
+    if kind == "exclusive":
+        return sorted(question)
+    return next(iter(question))
+
+
+class AkinatorServer:
+    """
+    Serve akinator games over `tree` to many concurrent clients from a single process.
+    The other arguments are the ones of AkinatorGame.
+    """
+    def __init__(self, tree, mutually_exclusive=(), questions=(),
+                 strategy="information_gain") -> None:
+        self.tree = tree
+        self.mutually_exclusive = mutually_exclusive
+        self.questions = tuple(questions)
+        self.strategy = strategy
+        self._exclusion = None
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """
+        Accept clients until cancelled. The questions are phrased and the tree is frozen
+        before the first client is accepted, so no game waits on the grammar checker or on
+        building the indexes of the tree.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.tree.precompute_questions)
+        self.tree.freeze()
+        self.exclusion()
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """
+        Play one game with the client of a connection. Every line the client sends is a JSON
+        object, and every reply of the server is one too:
+            {"start": true}       start a new game
+            {"resume": state}     resume a game from a state sent by the server earlier
+            {"answer": answer}    answer the pending question
+        The server replies {"question": question or null, "guesses": [...], "state": state},
+        the game being over when question is null, or {"error": message}.
+        """
+        game = None
+        try:
+            while line := await reader.readline():
+                try:
+                    game, reply = self.reply(game, json.loads(line))
+                except (ValueError, KeyError, TypeError) as error:
+                    reply = {"error": str(error)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass  # the client went away first
+
+    def exclusion(self):
+        """Return the ExclusionIndex shared by the games, building it on first use."""
+        if self._exclusion is None:
+            self._exclusion = ExclusionIndex(self.tree, self.mutually_exclusive)
+        return self._exclusion
+
+    def reply(self, game, message):
+        """Apply a client `message` to `game`, returning the game and the reply to send."""
+        if "start" in message:
+            game = AkinatorGame(self.tree, self.exclusion(), self.questions, self.strategy)
+            question = game.start()
+        elif "resume" in message:
+            game = AkinatorGame.from_state(self.tree, message["resume"],
+                                           self.exclusion(), self.questions)
+            question = game.next_question()
+        elif "answer" in message:
+            if game is None:
+                raise ValueError("Start or resume a game first")
+            question = game.answer(message["answer"])
+        else:
+            raise ValueError(f"Unknown message {message!r}")
+        return game, {"question": question, "guesses": game.guesses(), "state": game.state()}
+
+
+if __name__ == "__main__":
+    from node import GoalTree
+    from rules_example_zookeeper import TOURIST_RULES, TOURIST_MUTUALLY_EXCLUSIVE, TOURIST_QUESTIONS
+
+    server = AkinatorServer(GoalTree(rules=TOURIST_RULES), TOURIST_MUTUALLY_EXCLUSIVE, TOURIST_QUESTIONS)
+    asyncio.run(server.serve())
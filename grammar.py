@@ -0,0 +1,198 @@
+"""
+Grammar correction backends used to phrase the akinator questions.
+
+A corrector is any object with a `correct(text)` method. GoalTree uses the process-wide
+default corrector unless it is given one; the default is a LanguageTool corrector that
+starts its server on first use, or the local rule-based corrector when
+language_tool_python is not installed.
+"""
+import atexit
+from collections import OrderedDict
+import json
+import os
+import re
+import threading
+import zlib
+
+
+class NoopCorrector:
+    """Returns the text unchanged."""
+    def correct(self, text):
+        return text
+
+
+class RuleBasedCorrector:
+    """
+    Local corrector for questions of the form "Does it <fact>?", where the fact is
+    written in the third person ("Does it walks slowly?" -> "Does it walk slowly?",
+    "Does it is a tourist?" -> "Is it a tourist?").
+    """
+    QUESTION = re.compile(r"^Does it ((?:\w+ly )?)(\w+)\b(.*)$", re.DOTALL)
+    IRREGULAR = {"has": "have", "does": "do", "goes": "go"}
+
+    def correct(self, text):
+        match = self.QUESTION.match(text)
+        if match is None:
+            return text
+        adverb, verb, rest = match.groups()
+        if verb in ("is", "are"):
+            return f"Is it {adverb}{rest.lstrip()}"
+        return f"Does it {adverb}{self.base_form(verb)}{rest}"
+
+    def base_form(self, verb):
+        if verb in self.IRREGULAR:
+            return self.IRREGULAR[verb]
+        if verb.endswith("ies") and len(verb) > 4:
+            return verb[:-3] + "y"
+        if verb.endswith(("sses", "ches", "shes", "xes", "zes")):
+            return verb[:-2]
+        if verb.endswith("s") and not verb.endswith("ss"):
+            return verb[:-1]
+        return verb
+
+
+class LanguageToolCorrector:
+    """
+    Corrects text with LanguageTool. The LanguageTool server (a JVM) is only started
+    the first time a text is corrected, and is shared by every corrector of the same
+    language in the process.
+    """
+    _tools = {}
+    _lock = threading.Lock()
+
+    def __init__(self, language="en-US") -> None:
+        self.language = language
+
+    def tool(self):
+        tool = self._tools.get(self.language)
+        if tool is None:
+            with self._lock:
+                tool = self._tools.get(self.language)
+                if tool is None:
+                    import language_tool_python
+                    tool = language_tool_python.LanguageTool(self.language)
+                    atexit.register(tool.close)
+                    self._tools[self.language] = tool
+        return tool
+
+    def correct(self, text):
+        import language_tool_python
+        matches = self.tool().check(text)
+        return language_tool_python.utils.correct(text, matches)
+
+
+class QuestionCache:
+    """
+    Cache of phrased questions: a bounded in-memory tier evicting the least recently used
+    entry, and an optional on-disk tier in the directory `path`.
+
+    The on-disk tier is split into SHARDS JSON files by a hash of the question, and a shard
+    is only read when a question misses the in-memory tier, keeping at most `max_shards`
+    of them loaded. Questions put since the last save are written at the next save, or as
+    soon as `maxsize` of them are waiting, so memory stays bounded however large the
+    on-disk tier grows.
+    """
+    SHARDS = 256
+
+    def __init__(self, maxsize=4096, path=None, max_shards=16) -> None:
+        self.maxsize = maxsize
+        self.path = path
+        self.max_shards = max_shards
+        self._entries = OrderedDict()
+        self._shards = OrderedDict()  # shard number -> its questions, loaded on a miss
+        self._unsaved = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, text):
+        """Return the phrased question for `text`, or None when it is not cached."""
+        if text in self._entries:
+            self._entries.move_to_end(text)
+            return self._entries[text]
+        if self.path is None:
+            return None
+        phrased = self._unsaved.get(text)
+        if phrased is None:
+            phrased = self._shard(_shard_of(text, self.SHARDS)).get(text)
+        if phrased is not None:
+            self._remember(text, phrased)
+        return phrased
+
+    def put(self, text, phrased):
+        self._remember(text, phrased)
+        if self.path is not None:
+            self._unsaved[text] = phrased
+            if len(self._unsaved) >= self.maxsize:
+                self.save()
+
+    def save(self):
+        """Write the questions put since the last save to the on-disk tier, if there is one."""
+        if self.path is None or not self._unsaved:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        by_shard = {}
+        for text, phrased in self._unsaved.items():
+            by_shard.setdefault(_shard_of(text, self.SHARDS), {})[text] = phrased
+        for shard, questions in by_shard.items():
+            # Reread the shard, another process may have saved questions to it meanwhile
+            saved = self._read_shard(shard)
+            saved.update(questions)
+            path = self._shard_path(shard)
+            temporary = path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(saved, file, ensure_ascii=False, indent=0, sort_keys=True)
+            os.replace(temporary, path)
+            if shard in self._shards:
+                self._shards[shard] = saved
+        self._unsaved = {}
+
+    def _remember(self, text, phrased):
+        self._entries[text] = phrased
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _shard(self, shard):
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+            return self._shards[shard]
+        questions = self._shards[shard] = self._read_shard(shard)
+        while len(self._shards) > self.max_shards:
+            self._shards.popitem(last=False)
+        return questions
+
+    def _read_shard(self, shard):
+        path = self._shard_path(shard)
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, f"{shard:02x}.json")
+
+
+def _shard_of(text, shards):
+    return zlib.crc32(text.encode()) % shards
+
+
+_default_corrector = None
+
+
+def get_default_corrector():
+    """Return the corrector used by trees that were not given one."""
+    global _default_corrector
+    if _default_corrector is None:
+        try:
+            import language_tool_python  # noqa: F401
+            _default_corrector = LanguageToolCorrector()
+        except ImportError:
+            _default_corrector = RuleBasedCorrector()
+    return _default_corrector
+
+
+def set_default_corrector(corrector):
+    """Swap the corrector used by trees that were not given one, e.g. NoopCorrector()."""
+    global _default_corrector
+    _default_corrector = corrector
@@ -0,0 +1,122 @@
+"""
+Counters and latency histograms of the inference engines, exported for Prometheus.
+
+Metrics are off by default. Like tracing, every instrumented spot is guarded by
+`if METRICS.enabled:`, so with metrics off nothing is counted or timed. The loops of the
+goal tree and of forward chaining are not touched: their counts are derived from what the
+loop leaves behind (e.g. the facts forward chaining ended up knowing). The production
+matcher is the exception. regex_matches and bindings_created are counted one at a time, so
+production.match and every new utils.Bindings check the flag on each call, even while
+metrics are off. Turn metrics on with METRICS.enable(), or for a whole process with the
+GOALTREE_METRICS environment variable.
+
+Counters (see COUNTERS) add up the work done; histograms time each phase (see PHASES)
+in seconds. METRICS.snapshot() returns both as plain dicts and METRICS.prometheus()
+in the Prometheus text exposition format.
+"""
+from bisect import bisect_left
+import os
+
+COUNTERS = {
+    "nodes_visited": "Goal tree nodes visited by inference.",
+    "and_sets_evaluated": "AND-sets whose antecedent counts were updated.",
+    "regex_matches": "Patterns matched against facts.",
+    "bindings_created": "Variable bindings created by the production matcher.",
+    "rules_fired": "Production rules that changed the facts when applied.",
+}
+
+PHASES = {
+    "forward_chain": "GoalTree.forward_chain",
+    "backward_chain": "GoalTree.recursive_backward_chain",
+    "production_forward_chain": "production.forward_chain",
+    "narrowing": "recording an answer on an akinator session",
+    "question_selection": "choosing the next akinator question",
+    "grammar_correction": "phrasing a question with the grammar corrector",
+}
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """Latencies counted per bucket of BUCKETS, the last count being above all of them."""
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """Return the (upper bound, observations up to it) pairs, ending with +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class Metrics:
+    """The counters and phase histograms, updated while `enabled`."""
+    __slots__ = ("enabled", "counters", "histograms")
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {phase: Histogram() for phase in PHASES}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, phase, seconds):
+        self.histograms[phase].observe(seconds)
+
+    def snapshot(self):
+        """Return the counters and, for every phase, its count, sum and cumulative buckets."""
+        return {
+            "counters": dict(self.counters),
+            "histograms": {
+                phase: {"count": histogram.count, "sum": histogram.sum,
+                        "buckets": histogram.cumulative()}
+                for phase, histogram in self.histograms.items()
+            },
+        }
+
+    def prometheus(self, prefix="goaltree"):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, value in self.counters.items():
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# HELP {metric} {COUNTERS[name]}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        metric = f"{prefix}_phase_seconds"
+        lines.append(f"# HELP {metric} Latency of the inference phases.")
+        lines.append(f"# TYPE {metric} histogram")
+        for phase, histogram in self.histograms.items():
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{phase="{phase}",le="{le}"}} {count}')
+            lines.append(f'{metric}_sum{{phase="{phase}"}} {histogram.sum!r}')
+            lines.append(f'{metric}_count{{phase="{phase}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+if os.environ.get("GOALTREE_METRICS"):
+    METRICS.enable()
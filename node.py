@@ -1,31 +1,156 @@
-from rules_example_zookeeper import ZOOKEEPER_RULES, TOURIST_RULES
+from rules_example_zookeeper import ZOOKEEPER_RULES, TOURIST_RULES, TOURIST_MUTUALLY_EXCLUSIVE, TOURIST_QUESTIONS
 from  graphviz import Digraph
-from random import choice
-from icecream import ic
-import language_tool_python
-import random
+from grammar import QuestionCache, get_default_corrector
+from functools import lru_cache
+import gc
+import hashlib
+import os
+import sys
+import time
+from metrics import METRICS
+from production import AND, OR
+from utils import compile_template
+from game import AkinatorGame
+from session import SessionCore
+from compiled import CompiledGoalTree
+import snapshot
 
 class Node:
+    """
+    A fact of a goal tree. `or_set` holds the AND-sets of nodes that prove it and `parents`
+    the nodes it is an antecedent of. Both start as the shared empty tuple, become sets when
+    something is added to them, and can be turned back into tuples with compact() once the
+    tree is complete to save memory.
+    """
+    __slots__ = ("value", "parents", "or_set", "_children")
+
     def __init__(self, value, parents=None, or_set=None) -> None:
-        self.value = value
-        self.parents = parents if parents is not None else set()
-        self.or_set = or_set if or_set is not None else set()
+        self.value = sys.intern(value)
+        self.parents = parents if parents is not None else ()
+        self.or_set = or_set if or_set is not None else ()
+        self._children = None
+
+    def compact(self):
+        """Store the OR-set, its AND-sets and the parents as tuples."""
+        self.or_set = tuple(tuple(and_set) for and_set in self.or_set)
+        self.parents = tuple(self.parents)
 
     def children(self):
-        child_nodes = set()
-        for and_set in self.or_set:
-            for node in and_set:
-                child_nodes.add(node)
-        return child_nodes
+        """Return the tuple of the nodes in any of the AND-sets, computed once."""
+        if self._children is None:
+            self._children = tuple(dict.fromkeys(node for and_set in self.or_set
+                                                 for node in and_set))
+        return self._children
 
     def __repr__(self):
         return f"Node({self.value})"
 
+@lru_cache(maxsize=65536)
+def pattern_parts(pattern):
+    """
+    Return the (fact, subject) of a rule pattern: the fact it states about its subject, the
+    variable it starts with, and the name of that variable: '(?x) has hair' -> ('has hair',
+    'x'). Patterns that don't start with a variable are facts as they are, with no subject.
+    A goal tree node can't hold any other variable, so a pattern with one raises ValueError.
+    The pattern is parsed by the template parser shared with production.
+    """
+    template = compile_template(pattern)
+    subject = None
+    fact = pattern
+    if template.length > 1 and template.var_tokens and template.var_tokens[0][0] == 0:
+        subject = template.var_tokens[0][1]
+        fact = " ".join(pattern.split()[1:])
+    if len(template.vars) > (subject is not None):
+        raise ValueError(f"A goal tree can't represent {pattern!r}: "
+                         "only the leading variable of a pattern can be a variable")
+    return sys.intern(fact), subject
+
+
+def antecedent_and_sets(expression):
+    """
+    Return the list of pattern sequences, one per way of satisfying the antecedent
+    `expression`: an OR adds alternatives, an AND combines every alternative of its items.
+    """
+    if isinstance(expression, str):
+        return [(expression,)]
+    if isinstance(expression, OR):
+        return [patterns for item in expression for patterns in antecedent_and_sets(item)]
+    if isinstance(expression, AND):
+        for item in expression:
+            if not isinstance(item, str):
+                break
+        else:
+            # The common case, an AND of patterns
+            return [expression]
+        and_sets = [()]
+        for item in expression:
+            and_sets = [patterns + tuple(more) for patterns in and_sets
+                        for more in antecedent_and_sets(item)]
+        return and_sets
+    raise ValueError(f"A goal tree can't represent {expression!r}")
+
+
+class ChainIndex:
+    """
+    Flat view of the AND-sets of a goal tree, used by the agenda-driven forward chaining.
+    Every AND-set gets an integer id; each fact points to the AND-sets it appears in.
+    """
+    def __init__(self, nodes) -> None:
+        self.consequents = []  # AND-set id -> value of the node it proves
+        self.sizes = []        # AND-set id -> number of antecedents
+        self.watchers = {}     # fact -> ids of the AND-sets it is an antecedent of
+        for node in nodes.values():
+            for and_set in node.or_set:
+                idx = len(self.consequents)
+                self.consequents.append(node.value)
+                self.sizes.append(len(and_set))
+                for child in and_set:
+                    self.watchers.setdefault(child.value, []).append(idx)
+        # AND-sets without antecedents hold no matter what the data is
+        self.unconditional = [idx for idx, size in enumerate(self.sizes) if size == 0]
+
+class HypothesisIndex:
+    """
+    Bitsets over the hypotheses of a goal tree, bit i standing for hypotheses[i].
+    Every leaf fact maps to the mask of the hypotheses whose leaf closure contains it.
+    """
+    def __init__(self, nodes, closures) -> None:
+        self.hypotheses = [value for value, node in nodes.items() if node.or_set and not node.parents]
+        self.bits = {hypothesis: 1 << i for i, hypothesis in enumerate(self.hypotheses)}
+        self.fact_masks = {}
+        for hypothesis, bit in self.bits.items():
+            for fact in closures[hypothesis]:
+                self.fact_masks[fact] = self.fact_masks.get(fact, 0) | bit
+
 class GoalTree:
-    def __init__(self, rules) -> None:
+    def __init__(self, rules, corrector=None, question_cache_size=4096, question_cache_dir=None,
+                 compact_nodes=False) -> None:
+        """
+        `corrector` phrases the akinator questions, see grammar.py. By default the
+        process-wide corrector is used, which only starts LanguageTool when a question
+        is asked for the first time. Phrased questions are kept in an LRU cache of
+        `question_cache_size` entries and, when `question_cache_dir` is given, in a directory
+        named after the hash of the rule set (see precompute_questions).
+        With `compact_nodes`, the nodes are compacted after the rules are added, see compact().
+        """
         self.nodes = {}
+        self.compact_nodes = compact_nodes
+        self._rules = []
+        self.corrector = corrector
+        self.question_cache_size = question_cache_size
+        self.question_cache_dir = question_cache_dir
+        self._chain_index = None
+        self._leaf_closures = None
+        self._hypothesis_index = None
+        self._session_core = None
+        self._question_cache = None
+        self._compiled = None
+        self._rules_digest = None
+        self._source_digest = None
+        self._snapshot = None
+        self._snapshot_csr = None
+        self.frozen = False
         self.construct(rules)
-        self.tool = language_tool_python.LanguageTool('en-US') 
 
     def visualize_tree(self, output_filename="goal_tree"):
         """
@@ -64,27 +189,226 @@ class GoalTree:
         print(f"Tree diagram saved as {output_filename}.png")
 
     def construct(self, rules):
+        """
+        Add the rules to the tree in a single pass. Antecedents can nest AND and OR: each
+        rule adds one AND-set per way of satisfying its antecedent to every consequent.
+        A node stands for a fact about the subject of a rule, so rules with patterns about
+        another variable, or with a variable anywhere but at the start of a pattern, raise
+        ValueError like antecedents with a NOT do.
+        """
+        if self.frozen:
+            raise ValueError("Can't add rules to a frozen goal tree")
+        rules = list(rules)
+        # Building the graph allocates a lot of containers and frees none of them, so the
+        # cyclic garbage collector would only rescan the growing graph over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            # Every rule is checked before the tree changes, so a rejected rule leaves it
+            # as it was
+            parsed, facts = self._parse_rules(rules)
+            self._invalidate_indexes()
+            self._rules.extend(rules)
+            self._add_rules(parsed, facts)
+        finally:
+            if collecting:
+                gc.enable()
+        if self.compact_nodes:
+            self.compact()
+
+    def _parse_rules(self, rules):
+        """
+        Return the (consequent facts, AND-sets of antecedent facts) of every rule and the
+        facts of all the patterns, raising ValueError for a rule the tree can't represent.
+        """
+        parts = {}  # pattern -> (fact, subject), each pattern is only parsed once
+        parsed = []
         for rule in rules:
-            consequent = " ".join(rule.consequent()[0].split()[1:])
-            antecedents = [" ".join(antecedent.split()[1:]) for antecedent in rule.antecedent()]
-
-            # Create a new node for the consequent if it doesn't exist
-            if consequent not in self.nodes:
-                self.nodes[consequent] = Node(consequent)
-
-            consequent_node = self.nodes[consequent]
-            # Create nodes for each antecedent if they don't exist and add them to the OR-set
-            and_set = set()
-            for antecedent in antecedents:
-                if antecedent not in self.nodes:
-                    self.nodes[antecedent] = Node(antecedent)
-                and_set.add(self.nodes[antecedent])
-            
-            consequent_node.or_set.add(frozenset(and_set))
+            consequents = []
+            subject = None
+            for i, pattern in enumerate(rule.consequent()):
+                try:
+                    fact, other = parts[pattern]
+                except KeyError:
+                    fact, other = parts[pattern] = pattern_parts(pattern)
+                # Every pattern of the rule with a subject must be about the subject of its
+                # consequents, patterns without variables are facts about no one in particular
+                if i == 0:
+                    subject = other
+                elif other != subject:
+                    raise ValueError(f"The consequents of {rule} have different subjects")
+                consequents.append(fact)
+
+            and_sets = []
+            for patterns in antecedent_and_sets(rule.antecedent()):
+                facts = []
+                for pattern in patterns:
+                    try:
+                        fact, other = parts[pattern]
+                    except KeyError:
+                        fact, other = parts[pattern] = pattern_parts(pattern)
+                    if other != subject and other is not None:
+                        raise ValueError(f"A goal tree can't represent {rule}: {pattern!r} "
+                                         "isn't about the subject of the consequent")
+                    facts.append(fact)
+                and_sets.append(facts)
+            parsed.append((consequents, and_sets))
+        # In the order they are first seen, which is the order of the nodes
+        return parsed, dict.fromkeys(fact for fact, _ in parts.values())
+
+    def _add_rules(self, parsed, facts):
+        nodes = self.nodes
+        for fact in facts:
+            if fact not in nodes:
+                # The node interns the value, so the key and the value are the same string
+                nodes[fact] = Node(fact)
+
+        for consequents, and_sets in parsed:
+            consequent_nodes = [nodes[fact] for fact in consequents]
+            and_sets = [frozenset([nodes[fact] for fact in facts]) for facts in and_sets]
+            for consequent_node in consequent_nodes:
+                # Add the AND-sets to the OR-set of the consequent
+                or_set = consequent_node.or_set
+                if type(or_set) is tuple:
+                    or_set = consequent_node.or_set = set(frozenset(other) for other in or_set)
+                consequent_node._children = None
+                for and_set in and_sets:
+                    or_set.add(and_set)
+                    # Update the parent relationship
+                    for antecedent_node in and_set:
+                        parents = antecedent_node.parents
+                        if type(parents) is tuple:
+                            parents = antecedent_node.parents = set(parents)
+                        parents.add(consequent_node)
+
+    def freeze(self):
+        """
+        Make the tree read-only and build every index the akinator sessions use, so that
+        any number of sessions (or forked worker processes) can share it as is: adding
+        rules raises ValueError afterwards. The nodes are compacted. Returns the tree.
+        """
+        self.compact()
+        self.session_core()
+        self.frozen = True
+        return self
 
-            # Update the parent relationship
-            for antecedent_node in and_set:
-                antecedent_node.parents.add(consequent_node)
+    def compact(self):
+        """
+        Store the OR-sets, AND-sets and parents of every node as tuples, which take a
+        fraction of the memory of sets. Adding rules afterwards turns them back into sets.
+        """
+        for node in self.nodes.values():
+            node.compact()
+
+    def _invalidate_indexes(self):
+        """Drop the derived indexes, they are rebuilt lazily after the rules change."""
+        self._chain_index = None
+        self._leaf_closures = None
+        self._hypothesis_index = None
+        self._session_core = None
+        self._question_cache = None
+        self._compiled = None
+        self._rules_digest = None
+        self._source_digest = None
+        self._snapshot_csr = None
+
+    def rules_digest(self):
+        """Return a hex digest identifying the rule set the tree was built from."""
+        if self._rules_digest is None:
+            digest = hashlib.sha256()
+            for value in sorted(self.nodes):
+                and_sets = sorted(sorted(child.value for child in and_set)
+                                  for and_set in self.nodes[value].or_set)
+                digest.update(repr((value, and_sets)).encode())
+            self._rules_digest = digest.hexdigest()
+        return self._rules_digest
+
+    def source_digest(self):
+        """Return the sha256 digest (bytes) of the rules the tree was constructed from."""
+        if self._source_digest is None:
+            self._source_digest = snapshot.rules_source_digest(self._rules)
+        return self._source_digest
+
+    def save_compiled(self, path):
+        """
+        Save the compiled tree and its leaf closures to a binary snapshot at `path`, to be
+        loaded back by load_compiled. See snapshot.py for the format.
+        """
+        snapshot.save(self, path)
+
+    @classmethod
+    def load_compiled(cls, path, rules, **options):
+        """
+        Load the tree saved by save_compiled at `path`, instead of constructing it from
+        `rules`. The file is memory-mapped, but only the leaf closures and the CSR arrays
+        are shared between processes loading the same snapshot. The nodes are rebuilt in
+        each process, see snapshot.py. Raises ValueError if the snapshot was saved from
+        other rules or by another version of the format. `options` are passed on to the
+        constructor.
+        """
+        return snapshot.load(cls, path, rules, **options)
+
+    def adopt_compiled(self, values, consequents, indptr, indices, closures, rules,
+                       source_digest, rules_digest):
+        """
+        Replace the nodes of the tree with the ones described by compiled arrays, the
+        layout of CompiledGoalTree. Used by load_compiled. Every Node and AND-set is
+        created in this process's heap, and the nodes are left compact. The arrays are
+        kept for compiled(), and `closures` is used as given.
+        """
+        if self.frozen:
+            raise ValueError("Can't replace the nodes of a frozen goal tree")
+        nodes = [Node(value) for value in values]
+        or_sets = [[] for _ in nodes]
+        parents = [{} for _ in nodes]
+        for idx, consequent in enumerate(consequents):
+            antecedents = indices[indptr[idx]:indptr[idx + 1]]
+            or_sets[consequent].append(tuple(nodes[i] for i in antecedents))
+            for i in antecedents:
+                parents[i][nodes[consequent]] = None
+        for node, or_set, node_parents in zip(nodes, or_sets, parents):
+            node.or_set = tuple(or_set)
+            node.parents = tuple(node_parents)
+        self._invalidate_indexes()
+        self.nodes = {node.value: node for node in nodes}
+        self._rules = rules
+        self._leaf_closures = closures
+        self._source_digest = source_digest
+        self._rules_digest = rules_digest
+        self._snapshot_csr = (values, consequents, indptr, indices)
+
+    def chain_index(self):
+        """Return the ChainIndex of the tree, building it on first use."""
+        if self._chain_index is None:
+            self._chain_index = ChainIndex(self.nodes)
+        return self._chain_index
+
+    def compiled(self):
+        """Return the CompiledGoalTree of the tree, building it on first use."""
+        if self._compiled is None:
+            if self._snapshot_csr is not None:
+                # CompiledGoalTree indexes plain lists, so the mapped arrays are copied
+                values, consequents, indptr, indices = self._snapshot_csr
+                self._compiled = CompiledGoalTree.from_csr(values, consequents.tolist(),
+                                                           indptr.tolist(), indices.tolist())
+            else:
+                self._compiled = CompiledGoalTree(self)
+        return self._compiled
+
+    def forward_chain_batch(self, datas):
+        """
+        Forward chain many sets of facts at once on the compiled tree, returning the list
+        of inferred fact sets like forward_chain returns them, in the same order.
+        """
+        return self.compiled().forward_chain_batch(datas)
+
+    def forward_chain_many(self, fact_sets, chunk_size=1024, processes=None):
+        """
+        Yield the facts inferred from every fact set of the iterable `fact_sets`, in order,
+        sharing the compiled tree across all of them. See CompiledGoalTree.forward_chain_many
+        for streaming and the `processes` pool.
+        """
+        return self.compiled().forward_chain_many(fact_sets, chunk_size, processes)
 
     def display(self):
         """Display the goal tree structure."""
@@ -97,25 +421,41 @@ class GoalTree:
             print()
 
     def forward_chain(self, data):
-        """Forward chaining algorithm."""
+        """
+        Forward chaining algorithm.
+        Every AND-set keeps a counter of its antecedents that are not known yet. A fact
+        decrements the counters of the AND-sets it appears in and the consequent fires
+        when one of them reaches zero, so each fact is processed exactly once.
+        """
+        started = time.perf_counter() if METRICS.enabled else None
+        index = self.chain_index()
+        unmet = list(index.sizes)
         known_facts = set(data)
         inferred_facts = set()
-
-        while True:
-            applied_rule = False
-            for node in self.nodes.values():
-                # Check if the node can be inferred based on known facts
-                if node.value not in known_facts:
-                    # Check if any AND-Set (in OR-Set) can be satisfied
-                    for and_set in node.or_set:
-                        if all(antecedent.value in known_facts for antecedent in and_set):
-                            known_facts.add(node.value)
-                            inferred_facts.add(node.value)
-                            applied_rule = True
-                            break  # Rule applied, move to next node
-
-            if not applied_rule:
-                break  # No more rules can be applied, end forward chaining
+        agenda = list(known_facts)
+
+        def fire(idx):
+            consequent = index.consequents[idx]
+            if consequent not in known_facts:
+                known_facts.add(consequent)
+                inferred_facts.add(consequent)
+                agenda.append(consequent)
+
+        for idx in index.unconditional:
+            fire(idx)
+
+        while agenda:
+            fact = agenda.pop()
+            for idx in index.watchers.get(fact, ()):
+                unmet[idx] -= 1
+                if unmet[idx] == 0:
+                    fire(idx)
+        if started is not None:
+            # Every known fact went through the agenda once
+            METRICS.count("nodes_visited", len(known_facts))
+            METRICS.count("and_sets_evaluated",
+                          sum(len(index.watchers.get(fact, ())) for fact in known_facts))
+            METRICS.observe("forward_chain", time.perf_counter() - started)
         # self.print_inference_graph(data, inferred_facts)
         return inferred_facts
     
@@ -151,35 +491,67 @@ class GoalTree:
                 recursive_print(self.nodes[fact])
         print("========================================")
 
-    def recursive_backward_chain(self, hypothesis):
-        required_facts = set()
-        def recurse(node):
-            """
-            Recursive function to traverse the goal tree.
-            Accumulates required facts in `required_facts`.
-            """
-            # If the node has no antecedents, it's a fact or a terminal node
-            if not node.or_set:
-                return {node.value}
-
-            # Accumulate all the antecedents (AND-sets) that need to be satisfied
-            facts_needed_for_node = set()
-            for and_set in node.or_set:
-                facts_for_this_and_set = set()
-                for child in and_set:
-                    facts_for_this_and_set.update(recurse(child))
-                facts_needed_for_node.update(facts_for_this_and_set)
-
-            return facts_needed_for_node
-
-        # Start recursion from the hypothesis node
-        hypothesis_node = self.nodes[hypothesis]
-        required_facts.update(recurse(hypothesis_node))
-
-        return required_facts
-        
+    def leaf_closures(self):
+        """
+        Return a dict mapping every node value to the frozenset of leaf facts it depends on,
+        building it on first use. Shared sub-goals are resolved once, so the cost is linear
+        in the size of the goal tree even when it is a DAG with many paths to the same node.
+        """
+        if self._leaf_closures is not None:
+            return self._leaf_closures
+
+        closures = {}
+        visiting = set()
+        for root in self.nodes.values():
+            stack = [(root, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if node.value in closures:
+                    continue
+                # If the node has no antecedents, it's a fact or a terminal node
+                if not node.or_set:
+                    closures[node.value] = frozenset((node.value,))
+                    continue
+                if expanded:
+                    # Every child is resolved by now, except the ones closing a cycle
+                    facts = set()
+                    for child in node.children():
+                        facts.update(closures.get(child.value, ()))
+                    closures[node.value] = frozenset(facts)
+                    continue
+                if node.value in visiting:
+                    continue
+                visiting.add(node.value)
+                stack.append((node, True))
+                for child in node.children():
+                    if child.value not in closures and child.value not in visiting:
+                        stack.append((child, False))
+
+        self._leaf_closures = closures
+        if METRICS.enabled:
+            METRICS.count("nodes_visited", len(closures))
+        return closures
+
+    def hypothesis_index(self):
+        """Return the HypothesisIndex of the tree, building it on first use."""
+        if self._hypothesis_index is None:
+            self._hypothesis_index = HypothesisIndex(self.nodes, self.leaf_closures())
+        return self._hypothesis_index
+
+    def session_core(self):
+        """Return the SessionCore shared by the akinator sessions, building it on first use."""
+        if self._session_core is None:
+            self._session_core = SessionCore(self)
+        return self._session_core
 
-        
+    def recursive_backward_chain(self, hypothesis):
+        """Return the frozenset of leaf facts needed by any of the AND-sets under `hypothesis`."""
+        if not METRICS.enabled:
+            return self.leaf_closures()[hypothesis]
+        started = time.perf_counter()
+        closure = self.leaf_closures()[hypothesis]
+        METRICS.observe("backward_chain", time.perf_counter() - started)
+        return closure
 
     def backward_chain(self, hypothesis):
         """
@@ -240,222 +612,84 @@ class GoalTree:
                         print("or")
                         print("-", end="")
 
-    def akinator(self, mutually_exclusive, questions):
-        known_facts = set()
-        possible_hypotheses = set()
-        possible_facts = set()
-        possible_rules = set()
-        asked_facts = set()
-
-        for node in self.nodes:
-            if not self.nodes[node].or_set:
-                possible_facts.add(node)
-            elif not self.nodes[node].parents:
-                possible_hypotheses.add(node)
-            else:
-                possible_rules.add(node)
-
-        def correct_grammar(text):
-            matches = self.tool.check(text)
-            corrected_text = language_tool_python.utils.correct(text, matches)
-            return corrected_text
-
-        def ask_fact_question(fact):
-            """Ask a yes/no question about a fact."""
-            answer = input(correct_grammar(f"Does it {fact}?") + " (yes/no): ").strip().lower()
-            return answer == "yes"
-        
-        def ask_rating_question(question):
-            """Ask the user to rate a given question on a scale of 1 to 5."""
-            single_key = next(iter(question))
-            print(single_key)  # Display the question to the user
-            rating = None
-            ratings = set()
-            for i in range(1, len(question[single_key]) + 1):
-                ratings.add(i)
-
-            while rating not in ratings:
-                try:
-                    rating = int(input(f"Please rate 1-{len(question[single_key])}: ").strip())
-                    if rating not in ratings:
-                        print("Invalid input. Please enter a number between 1 and 5.")
-                except ValueError:
-                    print("Invalid input. Please enter a number between 1 and 5.")
-
-            return rating
-
-        def ask_mutually_exclusive_question(mutually_exclusive_set):
-            """Ask the user to choose which fact from a mutually exclusive set is true."""
-            print("Please choose the correct fact from the following options:")
-            for idx, fact in enumerate(mutually_exclusive_set, start=1):
-                print(f"{idx}. {fact}")
-            
-            # Get user input
-            choice_idx = -1
-            while choice_idx < 1 or choice_idx > len(mutually_exclusive_set):
-                try:
-                    choice_idx = int(input("Enter the number of the correct fact: ").strip())
-                except ValueError:
-                    print("Invalid input, please enter a valid number.")
-
-            # Return the chosen fact
-            chosen_fact = list(mutually_exclusive_set)[choice_idx - 1]
-            return chosen_fact
-        
-        def narrow():
-            not_possible_facts = set()
-            for fact in asked_facts:
-                if fact not in known_facts:
-                    not_possible_facts.add(fact)
-            # Using forward chaining removing not possible questions
-            while True:
-                applied_rule = False
-                for node in self.nodes.values():
-                    n = 0 # This n keeps track how many and sets are false in the or set
-                    for and_set in node.or_set:
-                        for child in and_set:
-                            if child.value in not_possible_facts:
-                                n += 1
-                                break
-                        # if all and_sets in the or set are false that we add the node to the not possible
-                        if n == len(node.or_set):
-                            if node.value not in not_possible_facts:
-                                not_possible_facts.add(node.value)
-                                applied_rule = True # This marks changes to the chain
-
-                # if no changes that we can break   
-                if not applied_rule:
-                    break
-            
-            # removing hypotheses that are in the not_possible_facts from the forward chain above
-            removed_hypotheses = set()
-            for fact in not_possible_facts:
-                if fact in possible_hypotheses:
-                    possible_hypotheses.remove(fact)
-                    removed_hypotheses.add(fact)
-            ic(possible_hypotheses)
-            ic(removed_hypotheses)
-            # collecting the facts from removed hypotheses and possible hypotheses using backward chain
-            facts = set()
-            for possible_hypothesis in possible_hypotheses:
-                facts.update(self.recursive_backward_chain(possible_hypothesis))
-            facts2 = set()
-            for possible_hypothesis in removed_hypotheses:
-                facts2.update(self.recursive_backward_chain(possible_hypothesis))
-            
-            # removing facts that are in removed hypotheses and not in possible hypotheses
-            not_possible_facts = set()
-            for fact in facts2:
-                if fact not in facts:
-                    not_possible_facts.add(fact)
-            
-            for fact in not_possible_facts:
-                if fact in possible_facts:
-                    possible_facts.remove(fact)
-                    ic(f"removing {fact}")
-            
-            # adding only possible rules
-            possible_rules = set()
-            for fact in self.forward_chain(list(possible_facts.union(known_facts))):
-                if self.nodes[fact].or_set and self.nodes[fact].parents:
-                    possible_rules.add(fact)
-            
-            # removing redundant question that don't add anything new
-            deducible_nodes = self.forward_chain(list(known_facts))
-            potential_redundant = set()
-            for node in deducible_nodes:
-                deducible_facts = self.recursive_backward_chain(node)
-                for fact in deducible_facts:
-                    if fact not in known_facts:
-                        potential_redundant.add(fact)
-            ic(potential_redundant)
-            # Generate all subsets of the potential_redundant (the power set)??
-            subsets = {}
-            for fact in potential_redundant:
-                for parent in self.nodes[fact].parents:
-                    if parent.value not in subsets:
-                        subsets[parent.value] = set()
-                    subsets[parent.value].add(fact)
-            
-            valid_facts = set()
-            for subset in subsets:
-                test_set = possible_facts.union(known_facts).difference(subsets[subset])
-                chain = self.forward_chain(list(test_set))
-                if subset not in chain:
-                    valid_facts.update(subsets[subset])
-            
-            for fact in potential_redundant:
-                if fact not in valid_facts and fact in possible_facts:
-                    possible_facts.remove(fact)
-                    ic(f"removing {fact}")
-            ic(possible_facts)
-
-        def choose_question():
-            if random.random() < 0.3:
-                if questions:
-                    question = questions.pop()
-                    rating = str(ask_rating_question(question))
-                    facts = question[next(iter(question))][rating]
-                    for fact in facts:
-                        if not fact in possible_facts:
-                            continue
-                        asked_facts.add(fact)
-                        known_facts.add(fact)
-                    return
-                    
-            fact = choice(list(possible_facts))
-            ic(mutually_exclusive)
-
-            flag = True
-            flag2 = False
-            mes = None
-            for mutually_exclusive_set in mutually_exclusive:
-                if fact in mutually_exclusive_set:
-                    flag2 = True
-                    for item in mutually_exclusive_set:
-                        if item not in possible_facts:
-                            flag = False
-                            break
-                    mes = mutually_exclusive_set
-                    break
-
-            if flag2 and flag:
-                fact = ask_mutually_exclusive_question(mes)
-                known_facts.add(fact)
-                ic(f"adding to known facts {fact}")
-                for item in mes:
-                    asked_facts.add(item)
-                    ic(f"adding to asked questions {item}")
-                    possible_facts.remove(item)
-                    ic(f"removing from possible facts {item}")
-            elif (flag2 and not flag) or (not flag2):
-                possible_facts.remove(fact)
-                ic(f"removing from possible facts {fact}")
-                if ask_fact_question(fact):
-                    known_facts.add(fact)
-                    ic(f"adding to known facts {fact}")
-                asked_facts.add(fact)
-                ic(f"adding to asked questions {fact}")
-        
-        while len(possible_facts) > 0:
-            # check if it can already find something
-            choose_question()
-            done = False
-            for node in self.forward_chain(list(known_facts)):
-                if node in possible_hypotheses:
-                    print(f"You are thinking of {node}")
-                    done = True
-            if done:
-                break
-
-            narrow()
-
-
-        
+    def _corrector(self):
+        return self.corrector if self.corrector is not None else get_default_corrector()
+
+    def correct_grammar(self, text):
+        return self._corrector().correct(text)
+
+    def question_cache(self):
+        """Return the cache of phrased questions, creating it on first use."""
+        if self._question_cache is None:
+            path = None
+            if self.question_cache_dir is not None:
+                # The corrector is part of the key, different backends phrase differently
+                key = f"{self.rules_digest()[:16]}-{type(self._corrector()).__name__}"
+                path = os.path.join(self.question_cache_dir, f"questions-{key}")
+            self._question_cache = QuestionCache(self.question_cache_size, path)
+        return self._question_cache
+
+    def fact_question(self, fact):
+        """Return the phrased yes/no question about `fact`, correcting it only on a cache miss."""
+        cache = self.question_cache()
+        text = f"Does it {fact}?"
+        question = cache.get(text)
+        if question is None:
+            started = time.perf_counter() if METRICS.enabled else None
+            question = self.correct_grammar(text)
+            if started is not None:
+                METRICS.observe("grammar_correction", time.perf_counter() - started)
+            cache.put(text, question)
+        return question
+
+    def precompute_questions(self):
+        """
+        Phrase the question of every leaf fact ahead of time and save them to the on-disk
+        cache, so the akinator never waits on the grammar checker during a game.
+        """
+        cache = self.question_cache()
+        for value, node in self.nodes.items():
+            if not node.or_set:
+                self.fact_question(value)
+        cache.save()
 
+    def akinator(self, mutually_exclusive, questions, strategy="information_gain"):
+        """
+        Play the guessing game on the console. `strategy` names the question selection
+        strategy from questions.STRATEGIES: "information_gain" (default) or "random".
+        This is a thin client of game.AkinatorGame, which plays games without blocking.
+        """
+        game = AkinatorGame(self, mutually_exclusive, questions, strategy)
+        question = game.start()
+        while question is not None:
+            question = game.answer(ask_on_console(question))
+        for hypothesis in game.guesses():
+            print(f"You are thinking of {hypothesis}")
+
+
+def ask_on_console(question):
+    """Ask a question of AkinatorGame with input() until it gets a valid answer."""
+    options = question["options"]
+    if question["kind"] == "fact":
+        answer = input(question["text"] + " (yes/no): ").strip().lower()
+        return answer == "yes"
+    print(question["text"])
+    if question["kind"] == "exclusive":
+        for idx, fact in enumerate(options, start=1):
+            print(f"{idx}. {fact}")
+        prompt = "Enter the number of the correct fact: "
+    else:
+        prompt = f"Please rate 1-{len(options)}: "
+    while True:
+        try:
+            choice = int(input(prompt).strip())
+            if 1 <= choice <= len(options):
+                return choice
+        except ValueError:
+            pass
+        print(f"Invalid input. Please enter a number between 1 and {len(options)}.")
 
 if __name__ == "__main__":
-    ic.disable()
     tree = GoalTree(rules=TOURIST_RULES)
     while True:
         print("Options:\n1)Backchain\n2)Akinator\n3)Exit")
@@ -466,16 +700,5 @@ if __name__ == "__main__":
             hypothesis = input("Give a valid hypothesis:")
             tree.backward_chain(hypothesis)
         else:
-            tree.akinator(mutually_exclusive=[{'wears bright flashy clothing', 'wears muted, utilitarian clothing'},
-                                                                    {'frequently checks for directions', 'uses tech to navigate efficiently'},
-                                                                    {'asks basic questions about lunar history', 'asks in-depth technical questions'},
-                                                                    {'wears business attire', 'wears adventure-themed clothing', 'wears stylish outfits', 'wears muted, utilitarian clothing'},
-                                                                    {'records videos constantly', 'talks nostalgically about earth'}],
-                                                                    questions=[
-                                                                        {"How familiar are they with lunar transportation?":{
-                                                                        "1": {"walks slowly", "frequently checks a device", "frequently checks for directions"},
-                                                                        "2": {"frequently checks a device", "frequently checks for directions"},
-                                                                        "3": {"frequently checks a device"},
-                                                                        "4": {"avoids hazards in lunar gravity"},
-                                                                        "5": {"uses tech to navigate efficiently", "avoids hazards in lunar gravity"}
-                                                                    }}])
\ No newline at end of file
+            tree.precompute_questions()
+            tree.akinator(mutually_exclusive=TOURIST_MUTUALLY_EXCLUSIVE, questions=list(TOURIST_QUESTIONS))
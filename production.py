@@ -1,5 +1,6 @@
 # import re
 import sys
+import time
 import regex
 
 if sys.version[0]=='2':
@@ -9,6 +10,7 @@ elif sys.version[0]=='3':
     import regex as re
 
 from utils import *
+from metrics import METRICS
 
 try:
     set()
@@ -31,7 +33,8 @@ except NameError:
 ### >>> import production
 ### >>> help(production)
 
-def forward_chain(rules, data, apply_only_one=False, verbose=False):
+def forward_chain(rules, data, apply_only_one=False, verbose=False,
+                  semi_naive=False):
     """
     Apply a list of IF-expressions (rules) through a set of data
     in order.  Return the modified data set that results from the
@@ -42,27 +45,193 @@ def forward_chain(rules, data, apply_only_one=False, verbose=False):
     _all_ possible bindings of its variables at the same time,
     making the code considerably more efficient. In the end, only
     DELETE rules will act differently.
-    """
-    old_data = ()
 
-    while set(old_data) != set(data):
-        old_data = list(data)
+    Set semi_naive=True to only try, each time a rule is applied,
+    the bindings that use at least one fact added since the rule
+    was last fully applied. The result is the same; rule sets with
+    DELETE rules, and rules with a NOT, are still applied naively.
+    """
+    store = FactStore(data)
+    if not rules or not store:
+        return data
+
+    started = time.perf_counter() if METRICS.enabled else None
+    if semi_naive and not any(rule._delete_clause for rule in rules):
+        _semi_naive_forward_chain(rules, store, apply_only_one, verbose)
+    else:
+        _naive_forward_chain(rules, store, apply_only_one, verbose)
+    if started is not None:
+        METRICS.observe("production_forward_chain",
+                        time.perf_counter() - started)
+    return store.data()
+
+
+def _naive_forward_chain(rules, store, apply_only_one, verbose):
+    """
+    forward_chain, starting over from the first rule every time
+    one of them changes the data.
+    """
+    changed = True
+    while changed:
+        changed = False
         for condition in rules:
-            data = condition.apply(data, apply_only_one, verbose)
-            if set(data) != set(old_data):
+            added, deleted = condition.apply_to(store, apply_only_one,
+                                                verbose)
+            if added or deleted:
+                if METRICS.enabled:
+                    METRICS.count("rules_fired")
+                changed = True
                 break
 
-    return data
+
+def _semi_naive_forward_chain(rules, store, apply_only_one, verbose):
+    """
+    forward_chain for rules that never delete anything: the data
+    only grows, so the bindings a rule has already fired for can't
+    add anything anymore.
+    """
+    # For each rule, the facts added since it was last fully applied,
+    # None until its first full pass, which matches the whole store
+    deltas = [None] * len(rules)
+    naive = [_contains_not(rule.antecedent()) for rule in rules]
+
+    changed = True
+    while changed:
+        changed = False
+        for i, condition in enumerate(rules):
+            added, deleted = condition.apply_to(
+                store, apply_only_one, verbose,
+                delta = None if naive[i] else deltas[i])
+            if not added:
+                deltas[i] = set()
+                continue
+            if METRICS.enabled:
+                METRICS.count("rules_fired")
+            if not apply_only_one:
+                # Otherwise the rule may have stopped at the first
+                # addition, and has to see the same delta again
+                deltas[i] = set()
+            for delta in deltas:
+                if delta is not None:
+                    delta.update(added)
+            changed = True
+            break
+
+def _contains_not(expression):
+    if isinstance(expression, NOT):
+        return True
+    if isinstance(expression, RuleExpression):
+        return any(_contains_not(item) for item in expression)
+    return False
 
 
 def backward_chain(rules, hypothesis, verbose=False):
     """
     Outputs the goal tree from having rules and hyphothesis, works like an "encyclopedia"
-    """
 
-    # TODO: you should implement backward_chain algorithm here
+    The result is the simplified AND/OR tree of every way to prove
+    the hypothesis: either it is known, or the antecedent of a rule
+    whose consequent matches it holds, each of its patterns being a
+    sub-goal expanded the same way.
+
+    Rules are found through an index of their consequents, and each
+    instantiated sub-goal is expanded only once. A sub-goal that is
+    reached again while it is being expanded is left as a leaf, so
+    cyclic rules terminate.
+    """
+    index = _ConsequentIndex(rules)
+    simplifier = _Simplifier()
+    memo = {}       # sub-goal -> simplified goal tree
+    expanding = set()  # the sub-goals being expanded
+
+    def expand(expression, bindings):
+        # Returns the goal tree and the sub-goals being expanded
+        # that it was cut at
+        if isinstance(expression, str):
+            return goal(_populate_goal(expression, bindings))
+        if isinstance(expression, NOT):
+            return simplifier.simplify(NOT(*[_populate_goal(item, bindings)
+                                             for item in expression])), frozenset()
+        branches = []
+        cuts = frozenset()
+        for item in expression:
+            tree, item_cuts = expand(item, bindings)
+            branches.append(tree)
+            cuts |= item_cuts
+        return simplifier.branches(expression, branches), cuts
+
+    def goal(hypothesis):
+        if hypothesis in memo:
+            return memo[hypothesis], frozenset()
+        if hypothesis in expanding:
+            return hypothesis, frozenset([hypothesis])
+        if verbose:
+            print("Goal:", hypothesis)
+        expanding.add(hypothesis)
+        branches = [hypothesis]
+        cuts = frozenset()
+        for rule, bindings in index.rules_for(hypothesis):
+            tree, rule_cuts = expand(rule.antecedent(), bindings)
+            branches.append(tree)
+            cuts |= rule_cuts
+        expanding.remove(hypothesis)
+        tree = simplifier.branches(OR(), branches)
+        cuts = cuts - frozenset([hypothesis])
+        # A tree cut at an enclosing goal depends on how it was
+        # reached, so only remember the complete ones
+        if not cuts:
+            memo[hypothesis] = tree
+        return tree, cuts
+
+    return goal(hypothesis)[0]
+
+def _populate_goal(pattern, bindings):
+    """
+    Like populate, but leaves the variables that 'bindings' has no
+    value for in place.
+    """
+    try:
+        return populate(pattern, bindings)
+    except KeyError:
+        return AIRegex.sub(lambda found: bindings.get(found.group(1),
+                                                      found.group(0)),
+                           pattern)
 
-    return "TODO: implement backward_chain" #change return
+class _ConsequentIndex(object):
+    """
+    The THEN patterns of a list of rules, indexed like FactStore
+    indexes facts: by their token count and their first constant
+    token, so that a goal only gets matched against the
+    consequents that could produce it.
+    """
+    def __init__(self, rules):
+        self._by_key = {}   # (length, position, token) or length -> [(order, rule, pattern)]
+        order = 0
+        for rule in rules:
+            for pattern in rule.consequent():
+                template = compile_template(pattern)
+                if template.constants:
+                    position, token = template.constants[0]
+                    key = (template.length, position, token)
+                else:
+                    key = template.length
+                self._by_key.setdefault(key, []).append((order, rule, pattern))
+                order += 1
+
+    def rules_for(self, goal):
+        """
+        Yield (rule, bindings) for every consequent that matches
+        'goal', in the order of the rules.
+        """
+        tokens = goal.split(' ')
+        found = list(self._by_key.get(len(tokens), ()))
+        for position, token in enumerate(tokens):
+            found.extend(self._by_key.get((len(tokens), position, token), ()))
+        found.sort(key=lambda entry: entry[0])
+        for order, rule, pattern in found:
+            bindings = match(pattern, goal)
+            if bindings is not None:
+                yield rule, bindings
 
 
 def instantiate(template, values_dict):
@@ -81,7 +250,7 @@ def instantiate(template, values_dict):
                                     for x in template])
     # elif isinstance(template, basestring):
     elif isinstance(template, str):
-        return AIStringToPyTemplate(template) % values_dict
+        return compile_template(template).instantiate(values_dict)
     else: raise ValueError ("Don't know how to populate a %s" % type(template))
 
 # alternate name for instantiate
@@ -97,12 +266,9 @@ def match(template, AIStr):
     to be substituted into template in order to make it equal to
     AIStr, or None if no such set exists.
     """
-    try:
-        return re.match( AIStringToRegex(template), 
-                         AIStr ).groupdict()
-    except AttributeError: # The re.match() expression probably
-                           # just returned None
-        return None
+    if METRICS.enabled:
+        METRICS.count("regex_matches")
+    return compile_template(template).match(AIStr)
 
 def is_variable(str):
     """Is 'str' a variable, of the form '(?x)'?"""
@@ -116,11 +282,10 @@ def variables(exp):
     Return a dictionary containing the names of all variables in
     'exp' as keys, or None if there are no such variables.
     """
-    try:
-        return re.search( AIStringToRegex(exp).groupdict() )
-    except AttributeError: # The re.match() expression probably
-                           # just returned None
+    template_vars = compile_template(exp).vars
+    if not template_vars:
         return None
+    return dict.fromkeys(template_vars)
         
 class IF(object):
     """
@@ -156,7 +321,13 @@ class IF(object):
         self._action = action
         self._delete_clause = delete_clause
 
-    def apply(self, rules, apply_only_one=False, verbose=False):
+        # Compile every pattern of the rule up front, so that matching
+        # and instantiating never has to rewrite them into regexes again
+        for expression in (conditional, action, delete_clause):
+            _compile_patterns(expression)
+
+    def apply(self, rules, apply_only_one=False, verbose=False,
+              delta=None):
         """
         Return a new set of data updated by the conditions and
         actions of this IF statement.
@@ -164,35 +335,66 @@ class IF(object):
         If 'apply_only_one' is True, after adding one datum,
         return immediately instead of continuing. This is the
         behavior described in class, but it is slower.
+
+        If 'delta' is a set of facts, only the bindings that use
+        at least one of them are tried (see forward_chain).
+
+        This copies the data; use apply_to to update a FactStore
+        in place.
         """
-        new_rules = set(rules)
-        old_rules_count = len(new_rules)
-        bindings = RuleExpression().test_term_matches(
-            self._conditional, new_rules)
+        store = FactStore(rules)
+        self.apply_to(store, apply_only_one, verbose, delta)
+        return store.data() # Uniquify and sort the output list
 
+    def apply_to(self, store, apply_only_one=False, verbose=False,
+                 delta=None):
+        """
+        Update the FactStore 'store' in place with the conditions
+        and actions of this IF statement, like apply does. Return
+        the lists of facts that were added and deleted.
+        """
+        if delta is None:
+            bindings = RuleExpression().test_term_matches(
+                self._conditional, store)
+        else:
+            bindings = RuleExpression().test_term_matches_delta(
+                self._conditional, store, delta)
+        # Every binding is found against the data as it was before
+        # the rule fired, so collect them before changing the store.
+        bindings = list(bindings)
+
+        added = []
+        deleted = []
+        old_count = len(store)
         for k in bindings:
             for a in self._action:
-                new_rules.add( populate(a, k) )
-                if len(new_rules) != old_rules_count:
+                fact = populate(a, k)
+                if store.add(fact):
+                    if fact in deleted:
+                        deleted.remove(fact)
+                    else:
+                        added.append(fact)
+                if len(store) != old_count:
                     if verbose:
                         print("Rule:", self)
-                        print("Added:", populate(a, k))
+                        print("Added:", fact)
                     if apply_only_one:
-                        return tuple(sorted(new_rules))
+                        return added, deleted
             for d in self._delete_clause:
-                try:
-                    new_rules.remove( populate(d, k) )
-                    if len(new_rules) != old_rules_count:
+                fact = populate(d, k)
+                if store.discard(fact):
+                    if fact in added:
+                        added.remove(fact)
+                    else:
+                        deleted.append(fact)
+                    if len(store) != old_count:
                         if verbose:
                             print("Rule:", self)
-                            print("Deleted:", populate(d, k))
+                            print("Deleted:", fact)
                         if apply_only_one:
-                            return tuple(sorted(new_rules))
-                except KeyError:
-                    pass
-                    
-        return tuple(sorted(new_rules)) # Uniquify and sort the
-                                        # output list
+                            return added, deleted
+
+        return added, deleted
 
 
     def __str__(self):
@@ -207,6 +409,121 @@ class IF(object):
 
     __repr__ = __str__
 
+def _compile_patterns(expression):
+    """Compile all the string patterns found in a (nested) expression."""
+    if isinstance(expression, str):
+        compile_template(expression)
+    elif expression is not None:
+        for item in expression:
+            _compile_patterns(item)
+
+class FactStore(object):
+    """
+    The working memory of forward chaining: a set of facts indexed
+    by their constant tokens, so that a pattern only gets tested
+    against the facts that could match it. For example '(?x) has
+    hair' is only tested against three-token facts ending in 'has
+    hair'.
+
+    Iterating over a FactStore, or reading its 'data' tuple, gives
+    the facts like the plain data tuples used everywhere else.
+    """
+    def __init__(self, facts = ()):
+        self._facts = set()
+        self._by_token = {}    # (length, position, token) -> facts
+        self._by_length = {}   # length -> facts
+        self._distinct = {}    # (length, position) -> number of tokens seen there
+        self._data = None
+        for fact in facts:
+            self.add(fact)
+
+    def _keys(self, fact):
+        tokens = fact.split(' ')
+        return len(tokens), [(len(tokens), i, token)
+                             for i, token in enumerate(tokens)]
+
+    def add(self, fact):
+        """Add a fact, returning True if it was not there yet."""
+        if fact in self._facts:
+            return False
+        self._facts.add(fact)
+        self._data = None
+        length, keys = self._keys(fact)
+        self._by_length.setdefault(length, set()).add(fact)
+        for key in keys:
+            bucket = self._by_token.get(key)
+            if not bucket:
+                if bucket is None:
+                    bucket = self._by_token[key] = set()
+                self._distinct[key[:2]] = self._distinct.get(key[:2], 0) + 1
+            bucket.add(fact)
+        return True
+
+    def discard(self, fact):
+        """Remove a fact, returning True if it was there."""
+        if fact not in self._facts:
+            return False
+        self._facts.remove(fact)
+        self._data = None
+        length, keys = self._keys(fact)
+        self._by_length[length].discard(fact)
+        for key in keys:
+            bucket = self._by_token[key]
+            bucket.discard(fact)
+            if not bucket:
+                self._distinct[key[:2]] -= 1
+        return True
+
+    def candidates(self, pattern, bindings = None):
+        """
+        Return the facts that may match 'pattern': the smallest
+        bucket among its constant tokens, and among its variable
+        tokens that 'bindings' gives a value.
+        """
+        template = compile_template(pattern)
+        best = self._by_length.get(template.length, ())
+        for position, token in template.constants:
+            bucket = self._by_token.get((template.length, position, token), ())
+            if len(bucket) < len(best):
+                best = bucket
+        if bindings:
+            for position, var in template.var_tokens:
+                token = bindings.get(var)
+                if token is None: continue
+                bucket = self._by_token.get((template.length, position, token), ())
+                if len(bucket) < len(best):
+                    best = bucket
+        return best
+
+    def estimate(self, pattern, bound = ()):
+        """
+        Estimate how many facts match 'pattern' once the variables
+        in 'bound' have a value, assuming each bound variable token
+        is equally likely to hold any of the tokens seen at its
+        position.
+        """
+        template = compile_template(pattern)
+        estimate = float(len(self.candidates(pattern)))
+        for position, var in template.var_tokens:
+            if var in bound:
+                estimate /= max(1, self._distinct.get((template.length, position), 0))
+        return estimate
+
+    def data(self):
+        """The facts as a sorted tuple, like IF.apply returns them."""
+        if self._data is None:
+            self._data = tuple(sorted(self._facts))
+        return self._data
+
+    def __contains__(self, fact):
+        return fact in self._facts
+
+    def __iter__(self):
+        return iter(self._facts)
+
+    def __len__(self):
+        return len(self._facts)
+
 class RuleExpression(list):
     """
     The parent class of AND, OR, and NOT expressions.
@@ -242,7 +559,8 @@ class RuleExpression(list):
         Given an expression which might be just a string, check
         it against the rules.
         """
-        rules = set(rules)
+        if not isinstance(rules, FactStore):
+            rules = FactStore(rules)
         if context_so_far == None: context_so_far = {}
 
         # Deal with nesting first If we're a nested term, we
@@ -256,16 +574,92 @@ class RuleExpression(list):
             return self.basecase_bindings(condition, 
                                           rules, context_so_far)
 
+    def test_term_matches_delta(self, condition, rules, delta,
+                                mode = 'delta'):
+        """
+        Semi-naive version of test_term_matches. With mode 'delta'
+        only yield the bindings that use at least one fact of
+        'delta', with mode 'old' only those that use none, and with
+        mode 'all' every binding.
+
+        A conjunction of conditions c1..cn uses a delta fact when,
+        for some i, c1..ci-1 match old facts, ci matches a delta fact
+        and ci+1..cn match anything; these cases are disjoint, so no
+        binding is produced twice.
+        """
+        if mode == 'all':
+            return self.test_term_matches(condition, rules)
+        if isinstance(condition, str):
+            return self._delta_basecase(condition, rules, delta,
+                                        mode == 'delta')
+        if isinstance(condition, OR):
+            return (bindings for item in condition
+                    for bindings in self.test_term_matches_delta(
+                        item, rules, delta, mode))
+        if isinstance(condition, AND):
+            conditions = condition.plan(rules).conditions
+            if mode == 'old':
+                return self._join(conditions, ['old'] * len(conditions),
+                                  rules, delta)
+            return (bindings for i in range(len(conditions))
+                    for bindings in self._join(
+                        conditions,
+                        ['old'] * i + ['delta']
+                        + ['all'] * (len(conditions) - i - 1),
+                        rules, delta))
+        raise ValueError("Semi-naive matching doesn't support %s"
+                         % condition)
+
+    def _delta_basecase(self, condition, rules, delta, in_delta,
+                        context_so_far = None):
+        candidates = rules.candidates(condition, context_so_far)
+        if in_delta and len(delta) < len(candidates):
+            # The delta facts are all in the store, so they are a
+            # smaller set of candidates
+            candidates = delta
+        for rule in candidates:
+            if (rule in delta) != in_delta: continue
+            bindings = match(condition, rule)
+            if bindings is None: continue
+            yield Bindings(bindings)
+
+    def _join(self, conditions, modes, rules, delta,
+              cumulative_dict = None, index = 0):
+        """Join the bindings of the conditions, like _test_matches_iter."""
+        if cumulative_dict == None:
+            cumulative_dict = EMPTY_BINDINGS
+        if index == len(conditions):
+            yield cumulative_dict
+            return
+        condition = conditions[index]
+        mode = modes[index]
+        # Look the facts of plain patterns up with the variables
+        # bound so far
+        if isinstance(condition, str) and mode == 'all':
+            matches = self.basecase_bindings(condition, rules,
+                                             cumulative_dict)
+        elif isinstance(condition, str):
+            matches = self._delta_basecase(condition, rules, delta,
+                                           mode == 'delta',
+                                           cumulative_dict)
+        else:
+            matches = self.test_term_matches_delta(condition, rules,
+                                                   delta, mode)
+        for bindings in matches:
+            bindings = cumulative_dict.extend(bindings)
+            if bindings is None: continue
+            for bindings2 in self._join(conditions, modes, rules, delta,
+                                        bindings, index + 1):
+                yield bindings2
+
     def basecase_bindings(self, condition, rules, context_so_far):
-        for rule in rules:
+        context_so_far = Bindings.of(context_so_far)
+        for rule in rules.candidates(condition, context_so_far):
             bindings = match(condition, rule)
             if bindings is None: continue
-            try:
-                context = NoClobberDict(context_so_far)
-                context.update(bindings)
+            context = context_so_far.extend(bindings)
+            if context is not None:
                 yield context
-            except ClobberedDictKey:
-                pass
 
     def get_condition_vars(self):
         if hasattr(self, '_condition_vars'):
@@ -277,7 +671,7 @@ class RuleExpression(list):
             if isinstance(condition, RuleExpression):
                 condition_vars |= condition.get_condition_vars()
             else:
-                condition_vars |= AIStringVars(condition)
+                condition_vars |= compile_template(condition).vars
                 
         return condition_vars
 
@@ -290,46 +684,103 @@ class RuleExpression(list):
     def __hash__(self):
         return hash((self.__class__.__name__, list(self)))
 
+class JoinPlan(object):
+    """
+    The order in which an AND matches its conditions, as chosen by
+    AND.plan. 'steps' holds a (condition, estimate) pair per
+    condition, where estimate is the expected number of facts the
+    condition matches at that point of the join, or None for the
+    nested expressions that keep their place. print() a plan to see
+    it.
+    """
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+        self.conditions = tuple([step[0] for step in self.steps])
+
+    def __str__(self):
+        lines = []
+        for i, (condition, estimate) in enumerate(self.steps):
+            if estimate is None:
+                estimate = 'in place'
+            else:
+                estimate = '~%.1f facts' % estimate
+            lines.append('%d. %s  %s' % (i + 1, condition, estimate))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return 'JoinPlan(%r)' % (self.conditions,)
+
 class AND(RuleExpression):
     """A conjunction of patterns, all of which must match."""
     class FailMatchException(Exception):
         pass
     
     def test_matches(self, rules, context_so_far = {}):
-        return self._test_matches_iter(rules, list(self))
+        if not isinstance(rules, FactStore):
+            rules = FactStore(rules)
+        return self._test_matches_iter(rules, self.plan(rules).conditions)
+
+    def plan(self, rules, bound = ()):
+        """
+        Return the JoinPlan used to match this AND against 'rules'.
+        Between nested expressions, the patterns are reordered so
+        that the one expected to match the fewest facts, given the
+        variables bound before it, runs first. Nested expressions
+        such as NOT keep their place, since what they match depends
+        on the variables bound before them.
+        """
+        if not isinstance(rules, FactStore):
+            rules = FactStore(rules)
+        bound = set(bound)
+        steps = []
+        patterns = []
+        for condition in list(self) + [None]:
+            if isinstance(condition, str):
+                patterns.append(condition)
+                continue
+            while patterns:
+                estimate, i = min((rules.estimate(pattern, bound), i)
+                                  for i, pattern in enumerate(patterns))
+                pattern = patterns.pop(i)
+                steps.append((pattern, estimate))
+                bound |= compile_template(pattern).vars
+            if condition is not None:
+                steps.append((condition, None))
+                if not isinstance(condition, NOT):
+                    bound |= condition.get_condition_vars()
+        return JoinPlan(steps)
 
     def _test_matches_iter(self, rules, conditions = None, 
-                           cumulative_dict = None):
+                           cumulative_dict = None, index = 0):
         """
-        Recursively generate all possible matches.
+        Recursively generate all possible matches, joining the
+        conditions from 'index' on.
         """
+        if conditions == None:
+            conditions = list(self)
         # Set default values for variables.  We can't set these
         # in the function header because values defined there are
         # class-local, and we need these to be reinitialized on
         # each function call.
         if cumulative_dict == None:
-            cumulative_dict = NoClobberDict()
+            cumulative_dict = EMPTY_BINDINGS
 
         # If we have no more conditions to analyze, pass the
         # dictionary that we've accumulated back up the
         # function-call stack.
-        if len(conditions) == 0:
+        if index == len(conditions):
             yield cumulative_dict
             return
             
         # Recursive Case
-        condition = conditions[0]
+        condition = conditions[index]
         for bindings in self.test_term_matches(condition, rules,
                                                cumulative_dict):
-            bindings = NoClobberDict(bindings)
-            
-            try:
-                bindings.update(cumulative_dict)
-                for bindings2 in self._test_matches_iter(rules,
-                  conditions[1:], bindings):
-                    yield bindings2
-            except ClobberedDictKey:
-                pass
+            bindings = cumulative_dict.extend(bindings)
+            if bindings is None: continue
+            for bindings2 in self._test_matches_iter(rules,
+              conditions, bindings, index + 1):
+                yield bindings2
 
             
 class OR(RuleExpression):
@@ -358,7 +809,7 @@ class NOT(RuleExpression):
         if matched:
             return
         else:
-            yield NoClobberDict()
+            yield EMPTY_BINDINGS
 
 
 class THEN(list):
@@ -409,36 +860,70 @@ def simplify(node):
     You should do this to the expressions you produce by backward
     chaining.
     """
-    if not isinstance(node, RuleExpression): return node
-    branches = uniq([simplify(x) for x in node])
-    if isinstance(node, AND):
-        return _reduce_singletons(_simplify_and(branches))
-    elif isinstance(node, OR):
-        return _reduce_singletons(_simplify_or(branches))
-    else: return node
-
-def _reduce_singletons(node):
-    if not isinstance(node, RuleExpression): return node
-    if len(node) == 1: return node[0]
-    return node
-
-def _simplify_and(branches):
-    for b in branches:
-        if b == FAIL: return FAIL
-    pieces = []
-    for branch in branches:
-        if isinstance(branch, AND): pieces.extend(branch)
-        else: pieces.append(branch)
-    return AND(*pieces)
-
-def _simplify_or(branches):
-    for b in branches:
-        if b == PASS: return PASS
-    pieces = []
-    for branch in branches:
-        if isinstance(branch, OR): pieces.extend(branch)
-        else: pieces.append(branch)
-    return OR(*pieces)
+    return _Simplifier().simplify(node)
+
+class _Simplifier(object):
+    """
+    The simplifier behind simplify(), hash-consing the trees it
+    builds: each simplified subtree is made once, as a canonical
+    object shared by all its occurrences, so branches are
+    deduplicated by identity instead of by comparing their str(),
+    and a subtree seen twice is only simplified once.
+    """
+    def __init__(self):
+        self._canonical = {}   # structural key -> canonical expression
+        self._simplified = {}  # id(expression) -> (expression, simplified)
+
+    def simplify(self, node):
+        if not isinstance(node, RuleExpression): return node
+        done = self._simplified.get(id(node))
+        if done is not None: return done[1]
+        if isinstance(node, (AND, OR)):
+            result = self.branches(node, [self.simplify(x) for x in node])
+        else:
+            result = self._intern(node)
+        # Keep 'node' alive so that its id isn't reused
+        self._simplified[id(node)] = (node, result)
+        return result
+
+    def branches(self, node, branches):
+        """
+        Simplify the expression 'node' whose branches simplify to
+        'branches', without simplifying them again.
+        """
+        if isinstance(node, AND):
+            kind, absorbing = AND, OR
+        elif isinstance(node, OR):
+            kind, absorbing = OR, AND
+        else: return node
+
+        seen = set()
+        pieces = []
+        for branch in branches:
+            key = self._key(branch)
+            if key in seen: continue
+            seen.add(key)
+            # An empty OR fails an AND, an empty AND passes an OR
+            if type(branch) is absorbing and not branch:
+                return branch
+            if isinstance(branch, kind): pieces.extend(branch)
+            else: pieces.append(branch)
+        if len(pieces) == 1: return pieces[0]
+        return self._intern(kind(*pieces))
+
+    def _key(self, node):
+        if isinstance(node, str): return node
+        return id(node)
+
+    def _intern(self, node):
+        if not node:
+            return PASS if isinstance(node, AND) else FAIL
+        if isinstance(node, (AND, OR)):
+            key = (type(node), tuple([self._key(x) for x in node]))
+        else:
+            # The branches of a NOT aren't simplified
+            key = (type(node), tuple([str(x) for x in node]))
+        return self._canonical.setdefault(key, node)
 
 PASS = AND()
 FAIL = OR()
@@ -0,0 +1,184 @@
+"""
+Question selection strategies for the akinator game, and a simulator to compare them.
+
+A strategy takes the session and the pending rating questions and returns a (kind, question)
+pair, where kind is one of:
+- "fact": question is a fact to confirm with yes/no,
+- "exclusive": question is a mutually exclusive set to pick one fact from, see
+  AkinatorSession.exclusive_group,
+- "rating": question is a rating question from the `questions` list.
+"""
+from math import log2
+import random
+from random import choice
+
+from session import AkinatorSession, ExclusionIndex
+
+
+def split_entropy(possible, masks):
+    """
+    Entropy (in bits) of the partition of the `possible` hypotheses induced by the outcome
+    masks of a question. Hypotheses that agree on every mask cannot be told apart by it.
+    """
+    total = possible.bit_count()
+    if not total:
+        return 0.0
+    groups = [possible]
+    for mask in masks:
+        refined = []
+        for group in groups:
+            for part in (group & mask, group & ~mask):
+                if part:
+                    refined.append(part)
+        groups = refined
+    entropy = 0.0
+    for group in groups:
+        p = group.bit_count() / total
+        entropy -= p * log2(p)
+    return entropy
+
+
+def random_question(session, questions):
+    """Ask a rating question 30% of the time, otherwise about a random possible fact."""
+    if random.random() < 0.3:
+        if questions:
+            return "rating", questions[-1]
+    fact = choice(list(session.possible_facts))
+    group = session.exclusive_group(fact)
+    if group is not None:
+        return "exclusive", group
+    return "fact", fact
+
+
+def most_informative_question(session, questions):
+    """
+    Ask the question that best splits the possible hypotheses. Every candidate is scored
+    with the hypothesis bitsets of the tree; ties go to the question touching more of them.
+    """
+    index = session.tree.hypothesis_index()
+    possible = session.hypothesis_mask
+    best, best_score = None, None
+
+    def consider(candidate, masks):
+        nonlocal best, best_score
+        covered = 0
+        for mask in masks:
+            covered |= mask
+        score = (split_entropy(possible, masks), (possible & covered).bit_count())
+        if best_score is None or score > best_score:
+            best, best_score = candidate, score
+
+    seen_groups = set()
+    for fact in sorted(session.possible_facts):
+        group = session.exclusive_group(fact)
+        if group is None:
+            consider(("fact", fact), [index.fact_masks.get(fact, 0)])
+        elif id(group) not in seen_groups:
+            seen_groups.add(id(group))
+            consider(("exclusive", group), [index.fact_masks.get(item, 0) for item in group])
+
+    for question in questions:
+        masks = []
+        for facts in question[next(iter(question))].values():
+            mask = 0
+            for fact in facts:
+                if fact in session.possible_facts:
+                    mask |= index.fact_masks.get(fact, 0)
+            masks.append(mask)
+        consider(("rating", question), masks)
+
+    return best
+
+
+STRATEGIES = {
+    "random": random_question,
+    "information_gain": most_informative_question,
+}
+
+
+def apply_answer(session, kind, question, answer, questions):
+    """Record the answer to a question chosen by a strategy on the session."""
+    if kind == "rating":
+        questions.remove(question)
+        for fact in question[next(iter(question))][answer]:
+            if fact in session.possible_facts:
+                session.record(fact, True)
+    elif kind == "exclusive":
+        session.choose(question, answer)
+    else:
+        session.record(question, answer)
+
+
+def sample_world(tree, hypothesis, rng):
+    """Pick one way of satisfying `hypothesis` and return the leaf facts it needs."""
+    facts = set()
+    seen = set()
+    stack = [tree.nodes[hypothesis]]
+    while stack:
+        node = stack.pop()
+        if node.value in seen:
+            continue
+        seen.add(node.value)
+        if not node.or_set:
+            facts.add(node.value)
+            continue
+        and_sets = sorted(node.or_set, key=lambda and_set: sorted(n.value for n in and_set))
+        stack.extend(rng.choice(and_sets))
+    return facts
+
+
+def oracle_answer(kind, question, world, related, rng):
+    """
+    Answer a question the way a user thinking of `world` would. A mutually exclusive set
+    always gets an answer, so when `world` has none of its members the user picks one of
+    the `related` facts of their hypothesis if they can.
+    """
+    if kind == "fact":
+        return question in world
+    if kind == "exclusive":
+        members = sorted(question)
+        chosen = ([item for item in members if item in world]
+                  or [item for item in members if item in related]
+                  or [rng.choice(members)])
+        return chosen[0]
+    ratings = question[next(iter(question))]
+    return max(sorted(ratings), key=lambda rating: len(ratings[rating] & world))
+
+
+def simulate(tree, strategy, mutually_exclusive=(), questions=(), runs=20, seed=0):
+    """
+    Play `runs` games against every hypothesis of the tree, answering from a sampled way
+    of satisfying it. Return the average number of questions per game and the fraction
+    of games that ended by guessing the right hypothesis.
+    """
+    select = STRATEGIES[strategy]
+    exclusion = ExclusionIndex(tree, mutually_exclusive)
+    rng = random.Random(seed)
+    random.seed(seed)
+    asked = 0
+    hits = 0
+    games = 0
+    for hypothesis in tree.hypothesis_index().hypotheses:
+        related = tree.recursive_backward_chain(hypothesis)
+        for _ in range(runs):
+            world = sample_world(tree, hypothesis, rng)
+            session = AkinatorSession(tree, exclusion)
+            pending = list(questions)
+            while session.possible_facts and not session.guesses():
+                kind, question = select(session, pending)
+                apply_answer(session, kind, question,
+                             oracle_answer(kind, question, world, related, rng), pending)
+                asked += 1
+            hits += hypothesis in session.guesses()
+            games += 1
+    return asked / games, hits / games
+
+
+if __name__ == "__main__":
+    from node import GoalTree
+    from rules_example_zookeeper import TOURIST_RULES, TOURIST_MUTUALLY_EXCLUSIVE, TOURIST_QUESTIONS
+
+    tree = GoalTree(rules=TOURIST_RULES)
+    for strategy in STRATEGIES:
+        average, accuracy = simulate(tree, strategy, TOURIST_MUTUALLY_EXCLUSIVE, TOURIST_QUESTIONS)
+        print(f"{strategy:<18} {average:5.2f} questions per hypothesis, {accuracy:.0%} guessed right")
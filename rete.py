@@ -0,0 +1,361 @@
+"""
+A Rete-style match network for production rules.
+
+ReteEngine compiles a list of IF rules into alpha memories (the facts
+matching each pattern) and beta memories (the partial matches of each
+conjunction), so adding or deleting a fact only propagates the
+matches it takes part in, instead of re-matching every rule against
+the whole working memory on every pass like forward_chain does.
+
+>>> from rete import rete_forward_chain
+>>> rete_forward_chain(ZOOKEEPER_RULES, data)
+
+gives the same result as production.forward_chain(ZOOKEEPER_RULES,
+data). Like forward_chain, rules that fire for several bindings at
+once try them in no particular order; results only differ when the
+outcome depends on that order.
+"""
+from production import AND, OR, NOT, FactStore, populate
+from utils import compile_template
+
+
+def _expand(expression):
+    """
+    Expand an antecedent into a disjunction of branches. Each branch
+    is a list of ('pos', pattern) and ('neg', pattern, visible)
+    items, where 'visible' holds the variables the NOT sees bound,
+    following the scoping of AND._test_matches_iter: only the
+    conditions that come before it in the same AND.
+    """
+    if isinstance(expression, str):
+        return [[('pos', expression)]]
+    if isinstance(expression, NOT):
+        if len(expression) != 1 or not isinstance(expression[0], str):
+            raise ValueError("ReteEngine only supports NOT of a single pattern: %s"
+                             % expression)
+        return [[('neg', expression[0], frozenset())]]
+    if isinstance(expression, OR):
+        return [branch for item in expression for branch in _expand(item)]
+    if isinstance(expression, AND):
+        branches = [([], frozenset())]
+        for item in expression:
+            extended = []
+            for branch, bound in branches:
+                for sub_branch in _expand(item):
+                    if isinstance(item, NOT):
+                        sub_branch = [('neg', item[0], bound)]
+                    extended.append((branch + sub_branch,
+                                     bound | _bound_vars(sub_branch)))
+            branches = extended
+        return [branch for branch, bound in branches]
+    raise ValueError("Don't know how to match a %s" % type(expression))
+
+def _bound_vars(branch):
+    bound = frozenset()
+    for item in branch:
+        if item[0] == 'pos':
+            bound |= compile_template(item[1]).vars
+    return bound
+
+
+class _Branch(object):
+    """
+    One conjunction of a rule: a chain of join nodes over its
+    positive patterns, and the NOT patterns checked on its complete
+    matches. A token is the tuple of facts matched so far.
+    """
+    def __init__(self, rule, items):
+        self.rule = rule
+        positives = [item[1] for item in items if item[0] == 'pos']
+        self.negatives = [(item[1], item[2]) for item in items
+                          if item[0] == 'neg']
+        self.patterns = [compile_template(p) for p in positives]
+
+        # join_vars[k]: variables of pattern k already bound by the
+        # patterns before it; the join at level k is keyed on them.
+        self.join_vars = []
+        bound = frozenset()
+        for template in self.patterns:
+            self.join_vars.append(tuple(sorted(template.vars & bound)))
+            bound |= template.vars
+        self.join_vars.append(())
+
+        size = len(self.patterns)
+        self.alpha = [{} for _ in range(size)]  # key -> {fact: bindings}
+        self.beta = [{} for _ in range(size)]   # key -> {token: bindings}
+        self.by_fact = {}                        # fact -> {(level, token)}
+
+    def _key(self, level, bindings):
+        return tuple(bindings[var] for var in self.join_vars[level])
+
+    def complete(self):
+        """Yield (token, bindings) for every complete match."""
+        if not self.patterns:
+            yield (), {}
+            return
+        for tokens in self.beta[-1].values():
+            for token, bindings in tokens.items():
+                yield token, bindings
+
+    def right_activate(self, level, fact, bindings, engine):
+        """A new fact matched the pattern at 'level'."""
+        key = self._key(level, bindings)
+        self.alpha[level].setdefault(key, {})[fact] = bindings
+        if level == 0:
+            parents = {(): {}}
+        else:
+            parents = self.beta[level - 1].get(key, {})
+        for token, parent_bindings in list(parents.items()):
+            merged = dict(parent_bindings)
+            merged.update(bindings)
+            self.left_activate(level, token + (fact,), merged, engine)
+
+    def left_activate(self, level, token, bindings, engine):
+        """A new token matched the patterns up to 'level'."""
+        key = self._key(level + 1, bindings)
+        self.beta[level].setdefault(key, {})[token] = bindings
+        for fact in token:
+            self.by_fact.setdefault(fact, set()).add((level, token))
+        if level + 1 == len(self.patterns):
+            engine._new_match(self, token)
+            return
+        for fact, fact_bindings in list(self.alpha[level + 1].get(key, {}).items()):
+            merged = dict(bindings)
+            merged.update(fact_bindings)
+            self.left_activate(level + 1, token + (fact,), merged, engine)
+
+    def remove(self, fact, levels):
+        """Forget a deleted fact and every token it takes part in."""
+        for level in levels:
+            template = self.patterns[level]
+            bindings = template.match(fact)
+            memory = self.alpha[level].get(self._key(level, bindings))
+            if memory is not None:
+                memory.pop(fact, None)
+        for level, token in self.by_fact.pop(fact, ()):
+            tokens = self.beta[level]
+            for key in list(tokens):
+                if tokens[key].pop(token, None) is not None:
+                    if not tokens[key]:
+                        del tokens[key]
+                    break
+            for other in token:
+                if other != fact and other in self.by_fact:
+                    self.by_fact[other].discard((level, token))
+
+
+class _Rule(object):
+    def __init__(self, rule):
+        self.rule = rule
+        self.actions = rule.consequent()
+        self.deletes = rule._delete_clause
+        self.branches = [_Branch(self, items)
+                         for items in _expand(rule.antecedent())]
+        self.has_negatives = any(branch.negatives
+                                 for branch in self.branches)
+        self.pending = []  # new complete matches, (branch, token)
+
+
+class ReteEngine(object):
+    """
+    Keeps the matches of a list of IF rules up to date as facts are
+    added and deleted. Use add_fact/remove_fact to change the working
+    memory, and run() to forward chain like production.forward_chain.
+    """
+    def __init__(self, rules, data = ()):
+        self.rules = [_Rule(rule) for rule in rules]
+        self.store = FactStore()
+        self._rescan = False
+
+        # When no rule deletes anything and a rule has no NOT, the
+        # matches it already fired for can never add anything again,
+        # so only its new matches have to be looked at.
+        self.monotone = not any(rule.deletes for rule in self.rules)
+
+        # Index the patterns like FactStore indexes facts, by their
+        # token count and most specific constant token.
+        self._patterns = {}   # (length, position, token) or length -> [(branch, level)]
+        for rule in self.rules:
+            for branch in rule.branches:
+                for level, template in enumerate(branch.patterns):
+                    if template.constants:
+                        position, token = template.constants[0]
+                        key = (template.length, position, token)
+                    else:
+                        key = template.length
+                    self._patterns.setdefault(key, []).append((branch, level))
+
+        for fact in data:
+            self._add(fact)
+
+    def _matching(self, fact):
+        tokens = fact.split(' ')
+        found = list(self._patterns.get(len(tokens), ()))
+        for position, token in enumerate(tokens):
+            found.extend(self._patterns.get((len(tokens), position, token), ()))
+        return found
+
+    def _new_match(self, branch, token):
+        branch.rule.pending.append((branch, token))
+
+    def add_fact(self, fact):
+        """Add a fact to the working memory, returning True if it is new."""
+        return self._add(fact)
+
+    def remove_fact(self, fact):
+        """Delete a fact from the working memory, returning True if it was there."""
+        if self._remove(fact):
+            # It may have been derived by a rule before, so every rule
+            # has to look at all of its matches again on the next run.
+            self._rescan = True
+            return True
+        return False
+
+    def _add(self, fact):
+        if not self.store.add(fact):
+            return False
+        by_branch = {}
+        for branch, level in self._matching(fact):
+            bindings = branch.patterns[level].match(fact)
+            if bindings is not None:
+                by_branch.setdefault(branch, []).append((level, bindings))
+        for branch, levels in by_branch.items():
+            for level, bindings in sorted(levels, key=lambda item: item[0]):
+                branch.right_activate(level, fact, bindings, self)
+        return True
+
+    def _remove(self, fact):
+        if not self.store.discard(fact):
+            return False
+        by_branch = {}
+        for branch, level in self._matching(fact):
+            if branch.patterns[level].match(fact) is not None:
+                by_branch.setdefault(branch, []).append(level)
+        for branch, levels in by_branch.items():
+            branch.remove(fact, levels)
+        return True
+
+    def data(self):
+        return self.store.data()
+
+    def matches(self, rule):
+        """Return the bindings the antecedent of 'rule' has right now."""
+        return [bindings for branch, token, bindings in self._matches(rule)]
+
+    def _matches(self, rule):
+        for branch in rule.branches:
+            for token, bindings in branch.complete():
+                if self._negatives_hold(branch, bindings):
+                    yield branch, token, bindings
+
+    def _negatives_hold(self, branch, bindings):
+        for pattern, visible in branch.negatives:
+            if compile_template(pattern).vars <= visible:
+                pattern = populate(pattern, bindings)
+            template = compile_template(pattern)
+            for fact in self.store.candidates(pattern):
+                if template.match(fact) is not None:
+                    return False
+        return True
+
+    def _fire(self, rule, apply_only_one, verbose):
+        """
+        Fire 'rule' like IF.apply does, returning True if it changed
+        the working memory.
+        """
+        if self.monotone and not rule.has_negatives:
+            pending, rule.pending = rule.pending, []
+            matches = [(branch, token, bindings)
+                       for branch, token, bindings in
+                       ((branch, token, self._bindings(branch, token))
+                        for branch, token in pending)
+                       if bindings is not None]
+        else:
+            rule.pending = []
+            matches = list(self._matches(rule))
+
+        # Apply the whole firing on top of the current data, the way
+        # IF.apply works on a copy of it, then propagate the deltas.
+        added = set()
+        removed = set()
+        old_count = len(self.store)
+
+        def count():
+            return old_count + len(added) - len(removed)
+
+        def commit():
+            for fact in removed:
+                self._remove(fact)
+            for fact in sorted(added):
+                self._add(fact)
+            return bool(added or removed)
+
+        for index, (branch, token, k) in enumerate(matches):
+            for a in rule.actions:
+                fact = populate(a, k)
+                if fact in removed:
+                    removed.discard(fact)
+                elif fact not in self.store:
+                    added.add(fact)
+                if count() != old_count:
+                    if verbose:
+                        print("Rule:", rule.rule)
+                        print("Added:", fact)
+                    if apply_only_one:
+                        # The current match may have actions left to
+                        # fire, so it stays pending with the ones not
+                        # looked at yet
+                        rule.pending[:0] = [(b, t) for b, t, _ in matches[index:]]
+                        return commit()
+            for d in rule.deletes:
+                fact = populate(d, k)
+                if fact in added:
+                    added.discard(fact)
+                elif fact in self.store and fact not in removed:
+                    removed.add(fact)
+                else:
+                    continue
+                if count() != old_count:
+                    if verbose:
+                        print("Rule:", rule.rule)
+                        print("Deleted:", fact)
+                    if apply_only_one:
+                        rule.pending[:0] = [(b, t) for b, t, _ in matches[index:]]
+                        return commit()
+        return commit()
+
+    def _bindings(self, branch, token):
+        """The bindings of a complete token, or None if it was deleted since."""
+        if not branch.patterns:
+            return {}
+        level = len(branch.patterns) - 1
+        for tokens in branch.beta[level].values():
+            if token in tokens:
+                return tokens[token]
+        return None
+
+    def run(self, apply_only_one=False, verbose=False):
+        """
+        Forward chain until no rule changes the working memory, and
+        return the resulting data like production.forward_chain does.
+        """
+        if self.monotone and self._rescan:
+            for rule in self.rules:
+                rule.pending = [(branch, token) for branch in rule.branches
+                                for token, _ in branch.complete()]
+            self._rescan = False
+        while True:
+            for rule in self.rules:
+                if self._fire(rule, apply_only_one, verbose):
+                    break
+            else:
+                return self.data()
+
+
+def rete_forward_chain(rules, data, apply_only_one=False, verbose=False):
+    """
+    Same as production.forward_chain, computed with a ReteEngine.
+    """
+    if not rules or not data:
+        return data
+    return ReteEngine(rules, data).run(apply_only_one, verbose)
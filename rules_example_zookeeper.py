@@ -171,4 +171,24 @@ TOURIST_RULES = (
              '(?x) moves slowly in lunar gravity',
              '(?x) talks nostalgically about Earth' ),  # T12
         THEN( '(?x) is an Earth retiree' ))
-)
\ No newline at end of file
+)
+
+# Facts of which exactly one holds, asked about as a single multiple choice question
+TOURIST_MUTUALLY_EXCLUSIVE = (
+    {'wears bright flashy clothing', 'wears muted, utilitarian clothing'},
+    {'frequently checks for directions', 'uses tech to navigate efficiently'},
+    {'asks basic questions about lunar history', 'asks in-depth technical questions'},
+    {'wears business attire', 'wears adventure-themed clothing', 'wears stylish outfits', 'wears muted, utilitarian clothing'},
+    {'records videos constantly', 'talks nostalgically about earth'},
+    )
+
+# Rating questions: every rating maps to the facts it confirms
+TOURIST_QUESTIONS = (
+    {"How familiar are they with lunar transportation?": {
+        "1": {"walks slowly", "frequently checks a device", "frequently checks for directions"},
+        "2": {"frequently checks a device", "frequently checks for directions"},
+        "3": {"frequently checks a device"},
+        "4": {"avoids hazards in lunar gravity"},
+        "5": {"uses tech to navigate efficiently", "avoids hazards in lunar gravity"}
+    }},
+    )
@@ -0,0 +1,369 @@
+from collections.abc import Set
+import time
+
+from metrics import METRICS
+from tracing import TRACER
+
+
+class SessionCore:
+    """
+    The starting state of every AkinatorSession over a tree, built once and shared by all
+    of them, see GoalTree.session_core(). It is never modified: sessions only record how
+    they differ from it.
+    """
+    def __init__(self, tree) -> None:
+        facts, hypotheses, rules = set(), set(), set()
+        for node in tree.nodes.values():
+            if not node.or_set:
+                facts.add(node.value)
+            elif not node.parents:
+                hypotheses.add(node.value)
+            else:
+                rules.add(node.value)
+        self.facts = frozenset(facts)
+        self.hypotheses = frozenset(hypotheses)
+        self.rules = frozenset(rules)
+        self.hypothesis_mask = (1 << len(tree.hypothesis_index().hypotheses)) - 1
+
+        index = tree.chain_index()
+        unmet = list(index.sizes)
+        deduced = {index.consequents[idx] for idx in index.unconditional}
+        deduce(index, unmet, deduced, list(deduced))
+        self.unmet = tuple(unmet)
+        self.deduced = frozenset(deduced)
+        self.open = {value: len(node.or_set) for value, node in tree.nodes.items()}
+
+        # leaf fact -> number of hypotheses that depend on it
+        self.support = {}
+        closures = tree.leaf_closures()
+        for hypothesis in self.hypotheses:
+            for fact in closures[hypothesis]:
+                self.support[fact] = self.support.get(fact, 0) + 1
+
+
+class ExclusionIndex:
+    """
+    The mutually exclusive sets of facts of an akinator configuration, compiled once for a
+    tree and shared by its sessions. `groups` are the sets in their original order and
+    `members[g]` the sorted members of groups[g]. A fact belongs to `groups_of[fact]`,
+    the first of which is the group it is asked with. `missing[g]` counts the members of
+    group g that are not facts of the tree, which therefore can never all be possible.
+    """
+    def __init__(self, tree, mutually_exclusive=()) -> None:
+        facts = tree.session_core().facts
+        self.groups = list(mutually_exclusive)
+        self.members = [tuple(sorted(group)) for group in self.groups]
+        self.groups_of = {}
+        for g, members in enumerate(self.members):
+            for fact in members:
+                self.groups_of.setdefault(fact, []).append(g)
+        self.missing = tuple(sum(fact not in facts for fact in members) for members in self.members)
+
+    @classmethod
+    def of(cls, tree, mutually_exclusive):
+        """Return `mutually_exclusive` if it is already an ExclusionIndex, else index it."""
+        if isinstance(mutually_exclusive, cls):
+            return mutually_exclusive
+        return cls(tree, mutually_exclusive)
+
+
+class SetOverlay(Set):
+    """
+    A set stored as its differences from a shared frozenset `base`, so that a new overlay
+    costs nothing however large the base is. Once more than half of the base is removed,
+    the overlay copies what is left and stops sharing the base.
+    """
+    __slots__ = ("_base", "_added", "_removed")
+
+    def __init__(self, base) -> None:
+        self._base = base
+        self._added = set()
+        self._removed = set()
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, value):
+        if value in self._base:
+            return value not in self._removed
+        return value in self._added
+
+    def __len__(self):
+        return len(self._base) - len(self._removed) + len(self._added)
+
+    def __iter__(self):
+        removed = self._removed
+        for value in self._base:
+            if value not in removed:
+                yield value
+        yield from self._added
+
+    def add(self, value):
+        if value in self._base:
+            self._removed.discard(value)
+        else:
+            self._added.add(value)
+
+    def discard(self, value):
+        if value in self._base:
+            self._removed.add(value)
+            if len(self._removed) * 2 > len(self._base):
+                self._base = frozenset(self)
+                self._added = set()
+                self._removed = set()
+        else:
+            self._added.discard(value)
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+        self.discard(value)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({set(self)!r})"
+
+
+class CountOverlay:
+    """Counters stored as their changes to a shared sequence or mapping `base`."""
+    __slots__ = ("_base", "_changes")
+
+    def __init__(self, base) -> None:
+        self._base = base
+        self._changes = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._changes[key]
+        except KeyError:
+            return self._base[key]
+
+    def __setitem__(self, key, count):
+        self._changes[key] = count
+
+
+def deduce(index, unmet, deduced, values):
+    """
+    Forward chain from newly established `values` over the ChainIndex `index`, updating
+    the `unmet` antecedent counts and the `deduced` set. Return the newly deduced nodes.
+    """
+    newly_deduced = []
+    agenda = list(values)
+    while agenda:
+        value = agenda.pop()
+        for idx in index.watchers.get(value, ()):
+            unmet[idx] -= 1
+            consequent = index.consequents[idx]
+            if unmet[idx] == 0 and consequent not in deduced:
+                deduced.add(consequent)
+                newly_deduced.append(consequent)
+                agenda.append(consequent)
+    if METRICS.enabled:
+        # The agenda went through the values and the newly deduced nodes once
+        visited = list(values) + newly_deduced
+        METRICS.count("nodes_visited", len(visited))
+        METRICS.count("and_sets_evaluated",
+                      sum(len(index.watchers.get(value, ())) for value in visited))
+    return newly_deduced
+
+
+class AkinatorSession:
+    """
+    Live state of one akinator game over a GoalTree.
+
+    The sets of possible hypotheses, facts and rules are kept up to date as answers
+    arrive: every answer only propagates along the AND-sets (`parents`/`or_set` edges)
+    that contain the answered fact, instead of re-deriving everything from the full
+    list of asked facts.
+
+    Sessions share the SessionCore of the tree and only store how they differ from it
+    (see SetOverlay and CountOverlay), so a new session costs a few hundred bytes
+    whatever the size of the tree, and grows with the answers it records.
+
+    `mutually_exclusive` is the list of mutually exclusive sets of facts, or their
+    ExclusionIndex to share it between sessions. The session counts the members of every
+    set that are no longer possible, see exclusive_group().
+    """
+    def __init__(self, tree, mutually_exclusive=()) -> None:
+        core = tree.session_core()
+        self.tree = tree
+        self.exclusion = ExclusionIndex.of(tree, mutually_exclusive)
+        self.known_facts = set()
+        self.asked_facts = set()
+        self.possible_hypotheses = SetOverlay(core.hypotheses)
+        self.possible_facts = SetOverlay(core.facts)
+        self.possible_rules = SetOverlay(core.rules)
+        self.deduced = SetOverlay(core.deduced)  # nodes that follow from the known facts
+        self.ruled_out = set()                   # nodes that can no longer hold
+
+        # bitset of the possible hypotheses, see GoalTree.hypothesis_index()
+        self.hypothesis_mask = core.hypothesis_mask
+
+        self._unmet = CountOverlay(core.unmet)  # AND-set id -> antecedents not known yet
+        self._blocked = set()                   # AND-sets with a ruled out antecedent
+        self._open = CountOverlay(core.open)    # node -> AND-sets not blocked yet
+        # leaf fact -> number of possible hypotheses that depend on it
+        self._support = CountOverlay(core.support)
+        # mutually exclusive group -> members that are no longer possible
+        self._missing = CountOverlay(self.exclusion.missing)
+
+    def record(self, fact, holds):
+        """
+        Record the answer to a question about `fact` and narrow the session. A fact that is
+        already known is left alone, deducing from it again would count it twice.
+        """
+        if fact in self.known_facts:
+            return
+        started = time.perf_counter() if TRACER.enabled or METRICS.enabled else None
+        self.asked_facts.add(fact)
+        if fact in self.possible_facts:
+            self._drop_fact(fact)
+        deduced = ()
+        if holds:
+            self.known_facts.add(fact)
+            deduced = self._deduce([fact])
+            self._drop_redundant(deduced)
+        elif fact not in self.known_facts:
+            self._rule_out(fact)
+        if started is not None:
+            seconds = time.perf_counter() - started
+            if METRICS.enabled:
+                METRICS.observe("narrowing", seconds)
+            if TRACER.enabled:
+                TRACER.event("record", session=id(self), fact=fact, holds=holds,
+                             deduced=deduced, possible_facts=len(self.possible_facts),
+                             possible_hypotheses=len(self.possible_hypotheses),
+                             seconds=seconds)
+
+    def choose(self, group, fact):
+        """
+        Record that `fact` is the member of the mutually exclusive set `group` that holds:
+        the other members are ruled out, along with everything only they supported.
+        """
+        if fact not in group:
+            raise ValueError(f"{fact!r} isn't in the mutually exclusive set {group!r}")
+        self.record(fact, True)
+        for sibling in group:
+            if sibling != fact:
+                self.record(sibling, False)
+
+    def exclusive_group(self, fact):
+        """
+        Return the mutually exclusive set `fact` is asked with if all of its members are
+        still possible, else None.
+        """
+        groups = self.exclusion.groups_of.get(fact)
+        if groups and self._missing[groups[0]] == 0:
+            return self.exclusion.groups[groups[0]]
+        return None
+
+    def guesses(self):
+        """Return the possible hypotheses that follow from the known facts."""
+        smaller, larger = sorted((self.deduced, self.possible_hypotheses), key=len)
+        return {value for value in smaller if value in larger}
+
+    def _deduce(self, values):
+        """Forward chain from newly established values, returning the newly deduced nodes."""
+        return deduce(self.tree.chain_index(), self._unmet, self.deduced, values)
+
+    def _rule_out(self, fact):
+        """
+        Propagate a negative answer: a node is ruled out once every AND-set in its OR-set
+        has a ruled out antecedent. The facts that only supported the hypotheses ruled out
+        this way are no longer worth asking about.
+        """
+        index = self.tree.chain_index()
+        bits = self.tree.hypothesis_index().bits
+        removed_hypotheses = []
+        ruled_out_before = len(self.ruled_out)
+        self.ruled_out.add(fact)
+        agenda = [fact]
+        while agenda:
+            value = agenda.pop()
+            if value in self.possible_hypotheses:
+                self.possible_hypotheses.remove(value)
+                self.hypothesis_mask &= ~bits[value]
+                removed_hypotheses.append(value)
+            self.possible_rules.discard(value)
+            for idx in index.watchers.get(value, ()):
+                if idx in self._blocked:
+                    continue
+                self._blocked.add(idx)
+                consequent = index.consequents[idx]
+                self._open[consequent] -= 1
+                if self._open[consequent] == 0 and consequent not in self.ruled_out:
+                    self.ruled_out.add(consequent)
+                    agenda.append(consequent)
+        if METRICS.enabled:
+            METRICS.count("nodes_visited", len(self.ruled_out) - ruled_out_before)
+
+        closures = self.tree.leaf_closures()
+        dropped = [] if TRACER.enabled else None
+        for hypothesis in removed_hypotheses:
+            for leaf in closures[hypothesis]:
+                self._support[leaf] -= 1
+                if self._support[leaf] == 0 and leaf in self.possible_facts:
+                    self._drop_fact(leaf)
+                    if dropped is not None:
+                        dropped.append(leaf)
+        if dropped is not None:
+            TRACER.event("rule_out", session=id(self), fact=fact,
+                         removed_hypotheses=removed_hypotheses, dropped_facts=dropped)
+
+    def _drop_redundant(self, deduced):
+        """
+        Remove questions that don't add anything new: a fact under a newly deduced node is
+        redundant for a parent that can still be derived without it.
+        """
+        closures = self.tree.leaf_closures()
+        potential_redundant = set()
+        for value in deduced:
+            potential_redundant.update(closures[value] - self.known_facts)
+        if not potential_redundant:
+            return
+
+        subsets = {}
+        for fact in potential_redundant:
+            for parent in self.tree.nodes[fact].parents:
+                subsets.setdefault(parent.value, set()).add(fact)
+
+        valid_facts = set()
+        for parent, subset in subsets.items():
+            if not self._derivable(parent, subset):
+                valid_facts.update(subset)
+
+        dropped = [] if TRACER.enabled else None
+        for fact in potential_redundant - valid_facts:
+            if fact in self.possible_facts:
+                self._drop_fact(fact)
+                if dropped is not None:
+                    dropped.append(fact)
+        if dropped is not None:
+            TRACER.event("drop_redundant", session=id(self), candidates=potential_redundant,
+                         dropped_facts=dropped)
+
+    def _drop_fact(self, fact):
+        """Remove a fact from the possible facts, counting it out of its exclusive sets."""
+        self.possible_facts.remove(fact)
+        for g in self.exclusion.groups_of.get(fact, ()):
+            self._missing[g] += 1
+
+    def _derivable(self, value, excluded):
+        """
+        Can `value` still be derived from the possible and known facts without `excluded`?
+        Only the sub-graph under `value` is visited.
+        """
+        memo = {}
+
+        def recurse(node):
+            if node.value in memo:
+                return memo[node.value]
+            if not node.or_set:
+                return node.value not in excluded and (
+                    node.value in self.possible_facts or node.value in self.known_facts)
+            memo[node.value] = False  # guards against cycles
+            memo[node.value] = any(all(recurse(child) for child in and_set)
+                                   for and_set in node.or_set)
+            return memo[node.value]
+
+        return recurse(self.tree.nodes[value])
@@ -0,0 +1,160 @@
+"""
+Binary snapshots of a compiled GoalTree, see GoalTree.save_compiled and GoalTree.load_compiled.
+
+A snapshot holds the string table of the node values, the AND-sets as CSR arrays over the
+node ids (the layout of CompiledGoalTree) and the precomputed leaf closures, also as CSR
+arrays. Loading memory-maps the file, which skips parsing the rules and computing the
+closures, but only part of the tree stays in the shared pages:
+  - The Node graph (every Node, AND-set tuple and interned value) is rebuilt in the heap
+    of each process that loads the snapshot. So is the CompiledGoalTree, whose arrays
+    compiled() copies into lists.
+  - The leaf closures and the CSR sections are read in place from the mapping, so every
+    process loading the same snapshot shares them. A leaf closure is only decoded into a
+    per-process frozenset the first time it is asked for.
+A snapshot therefore saves construction time, but each worker still holds its own copy
+of the graph.
+
+The header records the format version and a hash of the rule source, and a snapshot is only
+loaded for the very rules it was saved from.
+
+Layout, little-endian: the header, then every section aligned on 8 bytes.
+    header    magic, version, node count, AND-set count, source digest, tree digest,
+              then the (offset, size in bytes) of every section
+    strings   the UTF-8 node values joined by NUL characters
+    consequents, indptr, indices, closure_indptr, closure_indices
+              arrays of signed 64-bit integers
+The arrays are read in place, so snapshots are only loaded on little-endian machines.
+"""
+from collections.abc import Mapping
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"GOALTREE"
+VERSION = 1
+SECTIONS = ("strings", "consequents", "indptr", "indices", "closure_indptr", "closure_indices")
+HEADER = struct.Struct("<8sIII32s32s" + "QQ" * len(SECTIONS))
+
+
+def rules_source_digest(rules):
+    """Return the sha256 digest (bytes) of the source of a list of rules."""
+    digest = hashlib.sha256()
+    for rule in rules:
+        digest.update(repr(rule).encode())
+        digest.update(b"\n")
+    return digest.digest()
+
+
+def save(tree, path):
+    """Write the snapshot of `tree` to `path`."""
+    compiled = tree.compiled()
+    for value in compiled.values:
+        if "\0" in value:
+            raise ValueError(f"Can't save a node value containing NUL: {value!r}")
+    closures = tree.leaf_closures()
+    closure_indptr = [0]
+    closure_indices = []
+    for value in compiled.values:
+        closure_indices.extend(sorted(compiled.ids[fact] for fact in closures[value]))
+        closure_indptr.append(len(closure_indices))
+
+    sections = [
+        "\0".join(compiled.values).encode(),
+        _pack(compiled.consequents),
+        _pack(compiled.indptr),
+        _pack(compiled.indices),
+        _pack(closure_indptr),
+        _pack(closure_indices),
+    ]
+    layout = []
+    offset = _align(HEADER.size)
+    for data in sections:
+        layout.extend((offset, len(data)))
+        offset = _align(offset + len(data))
+    header = HEADER.pack(MAGIC, VERSION, len(compiled.values), len(compiled.consequents),
+                         tree.source_digest(), bytes.fromhex(tree.rules_digest()), *layout)
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(header)
+        for data, section_offset in zip(sections, layout[::2]):
+            file.write(b"\0" * (section_offset - file.tell()))
+            file.write(data)
+    # Replace the snapshot atomically, processes mapping the old file keep their pages
+    os.replace(temporary, path)
+
+
+def load(cls, path, rules, **options):
+    """
+    Load the GoalTree of class `cls` saved at `path`, checking it was saved from `rules`.
+    `options` are passed on to the GoalTree constructor. The nodes are rebuilt in this
+    process, and only the closures and the CSR sections are left in the mapping.
+    """
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < HEADER.size:
+        raise ValueError(f"{path} is not a goal tree snapshot")
+    magic, version, node_count, and_set_count, source_digest, tree_digest, *layout = \
+        HEADER.unpack_from(mapped)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a goal tree snapshot")
+    if version != VERSION:
+        raise ValueError(f"{path} is a version {version} snapshot, expected version {VERSION}")
+    if source_digest != rules_source_digest(rules):
+        raise ValueError(f"{path} was saved from other rules")
+    if sys.byteorder != "little":
+        raise ValueError("Goal tree snapshots can only be loaded on little-endian machines")
+
+    view = memoryview(mapped)
+    sections = {}
+    for name, offset, size in zip(SECTIONS, layout[::2], layout[1::2]):
+        section = view[offset:offset + size]
+        sections[name] = section if name == "strings" else section.cast("q")
+    values = [sys.intern(value) for value in str(sections["strings"], "utf-8").split("\0")]
+    if not node_count:
+        values = []
+    if len(values) != node_count or len(sections["consequents"]) != and_set_count:
+        raise ValueError(f"{path} is truncated or corrupted")
+
+    tree = cls(rules=(), **options)
+    tree.adopt_compiled(values, sections["consequents"], sections["indptr"], sections["indices"],
+                        _Closures(values, sections["closure_indptr"],
+                                  sections["closure_indices"]),
+                        list(rules), source_digest, tree_digest.hex())
+    tree._snapshot = mapped
+    return tree
+
+
+class _Closures(Mapping):
+    """The leaf closures of a snapshot, decoded from the mapped arrays on first access."""
+    def __init__(self, values, indptr, indices) -> None:
+        self._values = values
+        self._ids = {value: i for i, value in enumerate(values)}
+        self._indptr = indptr
+        self._indices = indices
+        self._decoded = {}
+
+    def __getitem__(self, value):
+        closure = self._decoded.get(value)
+        if closure is None:
+            i = self._ids[value]
+            closure = frozenset(self._values[j] for j in
+                                self._indices[self._indptr[i]:self._indptr[i + 1]])
+            self._decoded[value] = closure
+        return closure
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def _pack(numbers):
+    return struct.pack(f"<{len(numbers)}q", *numbers)
+
+
+def _align(offset):
+    return (offset + 7) & ~7
@@ -0,0 +1,87 @@
+"""
+The original matcher and forward chaining, written out plainly, and random rule sets to
+check the optimized ones against.
+
+The original production.match rewrote a pattern into a regex on every call and joined
+bindings in the written order, trying every fact. A variable used twice in a pattern is
+bound to its last occurrence, the others aren't checked.
+"""
+import random
+
+import regex
+
+from production import AND, IF, THEN
+from utils import AIStringToPyTemplate, AIStringToRegex
+
+PREDICATES = ("p", "q", "r", "s", "t")
+ATOMS = ("a", "b", "c")
+VARIABLES = ("(?x)", "(?y)")
+
+
+def match(pattern, fact):
+    """The original production.match."""
+    found = regex.match(AIStringToRegex(pattern), fact)
+    return None if found is None else found.groupdict()
+
+
+def matches(patterns, facts, bindings=None):
+    """Yield the bindings of every way the patterns match the facts, in the written order."""
+    bindings = {} if bindings is None else bindings
+    if not patterns:
+        yield bindings
+        return
+    for fact in sorted(facts):
+        found = match(patterns[0], fact)
+        if found is None:
+            continue
+        if any(bindings.get(var, value) != value for var, value in found.items()):
+            continue
+        yield from matches(patterns[1:], facts, {**bindings, **found})
+
+
+def forward_chain(rules, data):
+    """
+    The facts that follow from rules of the form IF(AND(patterns), THEN(patterns)). Rules
+    that never delete anything reach the same facts whatever order they fire in, with or
+    without apply_only_one.
+    """
+    facts = set(data)
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            for bindings in list(matches(list(rule.antecedent()), facts)):
+                for consequent in rule.consequent():
+                    fact = AIStringToPyTemplate(consequent) % bindings
+                    if fact not in facts:
+                        facts.add(fact)
+                        changed = True
+    return tuple(sorted(facts))
+
+
+def random_pattern(rng):
+    """A pattern of two or three tokens, often repeating a variable."""
+    def token():
+        return rng.choice(VARIABLES + (rng.choice(ATOMS),))
+    tokens = [token(), rng.choice(PREDICATES)]
+    if rng.random() < 0.5:
+        tokens.append(token())
+    return " ".join(tokens)
+
+
+def random_rules(seed):
+    """Return random rules that never delete anything and random facts for them."""
+    rng = random.Random(seed)
+    rules = []
+    for _ in range(rng.randint(1, 4)):
+        antecedent = [random_pattern(rng) for _ in range(rng.randint(1, 3))]
+        bound = sorted(var for var in VARIABLES if any(var in pattern for pattern in antecedent))
+        subject = rng.choice(bound) if bound else rng.choice(ATOMS)
+        rules.append(IF(AND(*antecedent), THEN(f"{subject} {rng.choice(PREDICATES)}")))
+    data = set()
+    for _ in range(rng.randint(2, 8)):
+        fact = f"{rng.choice(ATOMS)} {rng.choice(PREDICATES)}"
+        if rng.random() < 0.5:
+            fact += f" {rng.choice(ATOMS)}"
+        data.add(fact)
+    return rules, tuple(sorted(data))
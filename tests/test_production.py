@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+import reference
+from production import AND, IF, THEN, FactStore, forward_chain, match
+from utils import compile_template
+
+SEEDS = range(2000)
+
+# '(?y) p (?y)' matches 'a p c' binding y to c: the regex binds a repeated variable to
+# its last occurrence and doesn't check the others
+REPEATED_VARIABLE_RULES = (IF(AND("(?x) p (?y)", "(?y) p (?y)"), THEN("(?x) s")),)
+
+
+def random_facts(rng, count=30):
+    facts = set()
+    for _ in range(count):
+        tokens = [rng.choice(reference.ATOMS), rng.choice(reference.PREDICATES)]
+        if rng.random() < 0.5:
+            tokens.append(rng.choice(reference.ATOMS))
+        facts.add(" ".join(tokens))
+    return facts
+
+
+def as_set(bindings):
+    return {frozenset(dict(found).items()) for found in bindings}
+
+
+def test_repeated_variable_is_not_a_bound_token():
+    template = compile_template("(?y) p (?y) (?x)")
+    assert template.var_tokens == ((3, "x"),)
+    store = FactStore(("a p c",))
+    assert store.candidates("(?y) p (?y)", {"y": "c"}) == {"a p c"}
+
+
+def test_repeated_variable_forward_chain():
+    expected = ("a p c", "a s")
+    for apply_only_one in (False, True):
+        for semi_naive in (False, True):
+            assert forward_chain(REPEATED_VARIABLE_RULES, ("a p c",), apply_only_one,
+                                 semi_naive=semi_naive) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_match_agrees_with_the_original(seed):
+    rng = random.Random(seed)
+    facts = random_facts(rng)
+    for _ in range(20):
+        pattern = reference.random_pattern(rng)
+        for fact in facts:
+            assert match(pattern, fact) == reference.match(pattern, fact)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_candidates_hold_every_match(seed):
+    rng = random.Random(seed)
+    store = FactStore(random_facts(rng))
+    for _ in range(20):
+        pattern = reference.random_pattern(rng)
+        bindings = {"x": rng.choice(reference.ATOMS), "y": rng.choice(reference.ATOMS)}
+        candidates = store.candidates(pattern, bindings)
+        for fact in store:
+            found = reference.match(pattern, fact)
+            if found is not None and all(bindings[var] == value for var, value in found.items()):
+                assert fact in candidates
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_join_plan_finds_the_written_order_bindings(seed):
+    rng = random.Random(seed)
+    facts = random_facts(rng)
+    store = FactStore(facts)
+    condition = AND(*(reference.random_pattern(rng) for _ in range(rng.randint(2, 4))))
+    plan = condition.plan(store)
+    assert sorted(plan.conditions) == sorted(condition)
+    expected = as_set(reference.matches(list(condition), facts))
+    assert as_set(condition._test_matches_iter(store, plan.conditions)) == expected
+    assert as_set(condition._test_matches_iter(store, list(condition))) == expected
+
+
+@pytest.mark.parametrize("semi_naive", (False, True))
+@pytest.mark.parametrize("apply_only_one", (False, True))
+def test_forward_chain_agrees_with_the_original(apply_only_one, semi_naive):
+    for seed in SEEDS:
+        rules, data = reference.random_rules(seed)
+        assert (forward_chain(rules, data, apply_only_one, semi_naive=semi_naive)
+                == reference.forward_chain(rules, data)), seed
@@ -0,0 +1,28 @@
+import pytest
+
+import reference
+from production import AND, IF, THEN, forward_chain
+from rete import rete_forward_chain
+
+MULTI_ACTION_RULES = (IF("(?x) p", THEN("(?x) q", "(?x) r")),)
+
+
+def test_repeated_variable():
+    rules = (IF(AND("(?x) p (?y)", "(?y) p (?y)"), THEN("(?x) s")),)
+    for apply_only_one in (False, True):
+        assert rete_forward_chain(rules, ("a p c",), apply_only_one) == ("a p c", "a s")
+
+
+def test_apply_only_one_fires_every_action():
+    data = ("a p", "b p")
+    assert (rete_forward_chain(MULTI_ACTION_RULES, data, apply_only_one=True)
+            == forward_chain(MULTI_ACTION_RULES, data, apply_only_one=True)
+            == ("a p", "a q", "a r", "b p", "b q", "b r"))
+
+
+@pytest.mark.parametrize("apply_only_one", (False, True))
+def test_rete_agrees_with_the_original(apply_only_one):
+    for seed in range(2000):
+        rules, data = reference.random_rules(seed)
+        assert (rete_forward_chain(rules, data, apply_only_one)
+                == reference.forward_chain(rules, data)), seed
@@ -0,0 +1,60 @@
+"""
+Structured tracing of akinator sessions, written as JSON lines.
+
+Tracing is off by default. Every traced step is guarded by `if TRACER.enabled:`, so while
+it is off an event costs one attribute check and none of its fields are computed. Turn it
+on with TRACER.enable(file), or for a whole process by pointing the AKINATOR_TRACE
+environment variable at the file to append to. Every event is one JSON object per line:
+    {"time": 1700000000.0, "event": "record", "session": 140..., "fact": "...", ...}
+Sets in the fields are written as sorted lists.
+"""
+import json
+import os
+import sys
+import time
+
+
+class Tracer:
+    """Writes trace events to a file while `enabled`."""
+    __slots__ = ("enabled", "_file", "_owned")
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._file = None
+        self._owned = False  # whether _file was opened by enable and is closed by disable
+
+    def enable(self, file=None):
+        """
+        Write the events to `file`, a path or a text file, standard error by default.
+        A file opened from a path is closed by disable, or when tracing is enabled again.
+        """
+        self.disable()
+        owned = isinstance(file, (str, os.PathLike))
+        if owned:
+            file = open(file, "a", buffering=1)
+        self._file = file if file is not None else sys.stderr
+        self._owned = owned
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self._owned:
+            self._file.close()
+        self._file = None
+        self._owned = False
+
+    def event(self, name, **fields):
+        """Write the event `name` with its `fields`. Call sites check `enabled` first."""
+        record = {"time": time.time(), "event": name, **fields}
+        self._file.write(json.dumps(record, default=_jsonable) + "\n")
+
+
+def _jsonable(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Can't trace a {type(value).__name__}")
+
+
+TRACER = Tracer()
+if os.environ.get("AKINATOR_TRACE"):
+    TRACER.enable(os.environ["AKINATOR_TRACE"])
@@ -1,15 +1,20 @@
 import sys
+from functools import lru_cache
+
+from metrics import METRICS
 
 
 VERSION = 3
 if sys.version[0]=='2':
     VERSION = 2
     from UserDict import DictMixin
+    from collections import Mapping
     import re
     # print("2")
 elif sys.version[0]=='3':
     VERSION = 3
     from collections import UserDict
+    from collections.abc import Mapping
     import regex as re
     # print("3")
 
@@ -97,6 +102,68 @@ elif VERSION==3:
             return self._dict.keys()
 
 
+class Bindings(Mapping):
+    """
+    A compact, immutable set of variable bindings, used by the
+    matcher instead of NoClobberDict. Extending it returns a new
+    Bindings, or None when a variable would get two different
+    values, so failed unifications don't cost an exception.
+    """
+    __slots__ = ('_values',)
+
+    def __init__(self, values = None):
+        # The dict is owned by this object and never changed
+        self._values = {} if values is None else values
+        if METRICS.enabled:
+            METRICS.count("bindings_created")
+
+    @classmethod
+    def of(cls, mapping):
+        if isinstance(mapping, Bindings):
+            return mapping
+        return cls(dict(mapping))
+
+    def extend(self, other):
+        """
+        Return these bindings together with the ones in 'other',
+        or None if they disagree on the value of a variable.
+        """
+        if isinstance(other, Bindings):
+            other = other._values
+        values = self._values
+        if not values:
+            return Bindings(dict(other))
+        merged = None
+        for key, value in other.items():
+            current = values.get(key)
+            if current is None:
+                if merged is None:
+                    merged = dict(values)
+                merged[key] = value
+            elif current != value:
+                return None
+        if merged is None:
+            return self
+        return Bindings(merged)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Bindings(%r)' % self._values
+
+EMPTY_BINDINGS = Bindings()
+
+
 # A regular expression for finding variables.
 AIRegex = re.compile(r'\(\?(\S+)\)')
 
@@ -112,4 +179,72 @@ def AIStringToPyTemplate(AIStr):
 def AIStringVars(AIStr):
     # This is not the fastest way of doing things, but
     # it is probably the most explicit and robust
-    return set([ AIRegex.sub(r'\1', x) for x in AIRegex.findall(AIStr) ])
\ No newline at end of file
+    return set([ AIRegex.sub(r'\1', x) for x in AIRegex.findall(AIStr) ])
+
+
+# Characters that make a template token match something else than itself
+REGEX_SPECIALS = frozenset('.^$*+?{}[]\\|()')
+
+
+class AITemplate(object):
+    """
+    A pattern such as '(?x) has hair' compiled once: the regex that matches it,
+    the names of its variables and the python template that instantiates it.
+    """
+    def __init__(self, AIStr):
+        self.source = AIStr
+        self._regex = None
+        # AIRegex has a single group, so findall gives the variable names
+        names = AIRegex.findall(AIStr)
+        self.vars = frozenset(names)
+        self.py_template = AIStringToPyTemplate(AIStr)
+        # Variables never match a space, so a matching string has the same
+        # space-separated tokens as the template, and the constant ones must
+        # be equal (see production.FactStore). Tokens that are a whole
+        # variable, such as '(?x)', are as good as a constant once the
+        # variable is bound. A variable used twice is left out: the regex
+        # binds it to its last occurrence without checking the others.
+        tokens = AIStr.split(' ')
+        self.length = len(tokens)
+        constants = []
+        var_tokens = []
+        for i, token in enumerate(tokens):
+            if '(?' in token:
+                found = AIRegex.match(token)
+                if (found and found.end() == len(token)
+                        and names.count(found.group(1)) == 1):
+                    var_tokens.append((i, found.group(1)))
+            elif REGEX_SPECIALS.isdisjoint(token):
+                constants.append((i, token))
+        self.constants = tuple(constants)
+        self.var_tokens = tuple(var_tokens)
+
+    @property
+    def regex(self):
+        # Only compiled when the template is matched for the first time, parsing
+        # the template alone doesn't need it
+        if self._regex is None:
+            self._regex = re.compile(AIStringToRegex(self.source))
+        return self._regex
+
+    def match(self, AIStr):
+        """Return the variable bindings that turn this template into AIStr, or None."""
+        regex = self._regex
+        if regex is None:
+            regex = self.regex
+        match = regex.match(AIStr)
+        if match is None:
+            return None
+        return match.groupdict()
+
+    def instantiate(self, values_dict):
+        return self.py_template % values_dict
+
+    def __repr__(self):
+        return "AITemplate(%r)" % self.source
+
+
+@lru_cache(maxsize=65536)
+def compile_template(AIStr):
+    """Return the AITemplate of AIStr, compiling it only the first time it is seen."""
+    return AITemplate(AIStr)